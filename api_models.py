@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+MAX_ENTITLEMENT_USER_IDS = 5000
 
 class SerializedProduct(BaseModel):
     product_hash: str
@@ -29,3 +31,11 @@ class SerializedSubscription(BaseModel):
     status: str
     is_active: bool
     next_payment_at: int
+
+class EntitlementsRequest(BaseModel):
+    user_ids: list[str] = Field(max_length=MAX_ENTITLEMENT_USER_IDS)
+
+class SerializedEntitlement(BaseModel):
+    user_id: str
+    is_active: bool
+    next_payment_at: int | None  # None if the user has never subscribed
@@ -0,0 +1,65 @@
+MIN_LOGS_BLOCK_RANGE = 1
+INITIAL_LOGS_BLOCK_RANGE = 100
+MAX_LOGS_BLOCK_RANGE = 50000
+
+# A getLogs response is considered cheap (and the range is grown) if it has fewer logs than this and came back quickly enough.
+CHEAP_RESPONSE_MAX_LOGS = 1000
+CHEAP_RESPONSE_MAX_SECONDS = 2.0
+
+# Providers don't agree on error codes for oversized getLogs requests, so they are recognized by their messages. E.g.
+# "query returned more than 10000 results", "block range is too large", "exceed maximum block range: 2000", "Log response size exceeded",
+# "eth_getLogs is limited to a 10,000 range".
+RANGE_ERROR_HINTS = ('more than', 'too large', 'too wide', 'block range', 'response size', 'limited to', 'timeout', 'timed out')
+
+# Rate limits must not shrink the range, e.g. "429, message='Too Many Requests'" or "project ID request rate exceeded".
+RATE_LIMIT_HINTS = ('too many requests', 'rate limit', 'rate-limit', 'ratelimit', 'request rate', 'quota', 'throttl')
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status = getattr(error, 'status', None)  # aiohttp
+    status_code = getattr(getattr(error, 'response', None), 'status_code', None)  # requests
+    if status == 429 or status_code == 429:
+        return True
+
+    message = str(error).lower()
+    return any(hint in message for hint in RATE_LIMIT_HINTS)
+
+
+def is_range_error(error: Exception) -> bool:
+    if is_rate_limit_error(error):
+        return False
+
+    if isinstance(error, TimeoutError):
+        return True
+
+    message = str(error).lower()
+    return any(hint in message for hint in RANGE_ERROR_HINTS)
+
+
+class AdaptiveBlockRange:
+    """Size of getLogs block windows learned from the responses of a single RPC provider."""
+
+    def __init__(
+            self,
+            initial_size: int = INITIAL_LOGS_BLOCK_RANGE,
+            min_size: int = MIN_LOGS_BLOCK_RANGE,
+            max_size: int = MAX_LOGS_BLOCK_RANGE,
+    ) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(initial_size, max_size))
+
+    def window_end(self, from_block: int, latest_block: int) -> int:
+        return min(from_block + self.size - 1, latest_block)
+
+    def on_response(self, logs_count: int, elapsed_seconds: float) -> None:
+        if logs_count < CHEAP_RESPONSE_MAX_LOGS and elapsed_seconds < CHEAP_RESPONSE_MAX_SECONDS:
+            self.size = min(self.size * 2, self.max_size)
+
+    def on_range_error(self) -> bool:
+        """Halves the range. Returns False if it can't be made any smaller, i.e. the error is not caused by the range."""
+        if self.size <= self.min_size:
+            return False
+
+        self.size = max(self.size // 2, self.min_size)
+        return True
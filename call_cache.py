@@ -0,0 +1,60 @@
+from typing import Any, NamedTuple
+from eth_typing import ChecksumAddress, HexStr
+from hexbytes import HexBytes
+from web3 import AsyncWeb3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.contract.async_contract import AsyncContract
+
+from common_types import Chain
+from database import Database
+from utils import LRUCache
+
+CALL_CACHE_SIZE = 10000
+
+
+class CallKey(NamedTuple):
+    chain: Chain
+    contract_address: ChecksumAddress
+    selector: HexStr
+    args: HexStr  # abi-encoded
+
+
+class ImmutableCallCache:
+    """Results of contract calls that can never change, e.g. token decimals or router products.
+
+    Raw return data is kept in memory and in the database, so each call is made on-chain only once, even across restarts.
+    Only functions whose results are immutable may be called through it.
+    """
+
+    def __init__(self, web3: AsyncWeb3, db: Database, chain: Chain) -> None:
+        self.web3 = web3
+        self.db = db
+        self.chain = chain
+        self._results: LRUCache[CallKey, HexStr] = LRUCache(CALL_CACHE_SIZE)
+
+    async def call(self, contract: AsyncContract, fn_name: str, *args: Any) -> Any:
+        """Same as contract.functions.<fn_name>(*args).call()"""
+        call_data = contract.encodeABI(fn_name=fn_name, args=list(args))
+        key = CallKey(chain=self.chain, contract_address=contract.address, selector=HexStr(call_data[:10]), args=HexStr('0x' + call_data[10:]))
+
+        result = self._results.get(key)
+        if result is None:
+            result = await self.db.get_call_result(*key)
+            if result is None:
+                result = HexStr(HexBytes(await self.web3.eth.call({'to': contract.address, 'data': call_data})).hex())
+                # Unset storage reads as zeros, e.g. for a product that is not created yet. It may still be set later.
+                if not any(HexBytes(result)):
+                    return self.decode(contract, fn_name, result)
+
+                await self.db.store_call_result(*key, result=result)
+
+            self._results.put(key, result)
+
+        return self.decode(contract, fn_name, result)
+
+    def decode(self, contract: AsyncContract, fn_name: str, result: HexStr) -> Any:
+        output_types = get_abi_output_types(contract.get_function_by_name(fn_name).abi)
+        # Normalized the same way as by ContractFunction.call(), e.g. addresses are checksummed
+        outputs = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, self.web3.codec.decode(output_types, HexBytes(result)))
+        return outputs[0] if len(outputs) == 1 else outputs
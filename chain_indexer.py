@@ -1,28 +1,46 @@
+import asyncio
 import json
+import time
 import traceback
-from typing import Any
-import base58
-from eth_typing import ChecksumAddress
+from typing import Any, Awaitable, Callable
+from eth_abi.exceptions import DecodingError
+from eth_typing import ChecksumAddress, HexStr
+from eth_utils import event_abi_to_log_topic
 from requests import HTTPError
-import requests
-from common_types import Chain, Product, Subscription, SubscriptionLog
-from constants import IPFS_VERSION, PINATA_BASE_URL
-from database import Database
-from web3 import AsyncWeb3, AsyncHTTPProvider
-from web3.types import Wei
+from block_range import AdaptiveBlockRange, is_range_error, is_rate_limit_error
+from call_cache import ImmutableCallCache
+from common_types import Chain, Product, Subscription, SubscriptionLog, Token
+from database import BlockCheckpoint, Database, WriteBatch
+from fee_estimator import FeeEstimator
+from metadata_resolver import MetadataResolver, minimized_ipfs_cid_to_cid
+from multicall import Call, Multicall
+from payment_pipeline import NonceManager, PendingPayment, ReceiptTracker
+from web3 import AsyncWeb3, AsyncHTTPProvider, Web3
+from web3.contract.async_contract import AsyncContractEvent
+from web3.exceptions import BadFunctionCallOutput, BlockNotFound, ContractLogicError
+from web3.logs import DISCARD
+from web3.types import EventData, FilterParams, LogReceipt, Nonce, TxParams, Wei
 from eth_account.signers.local import LocalAccount
 import logging
-from web3.exceptions import TimeExhausted
-from price_oracle import get_token_to_eth_price
+from price_oracle import PriceOracle
 from web3.middleware.geth_poa import async_geth_poa_middleware
 
 from utils import ts_now
 
-MAX_LOGS_BLOCK_RANGE = 100
-
 SECOND_PAYMENT_GAS = 120000
 GAS_PER_PAYMENT = 100000
 
+MAX_PENDING_PAYMENTS = 200
+PAYMENT_RECEIPT_TIMEOUT = 120  # seconds after which an unconfirmed payment means that the initiator is stuck
+PRODUCT_HYDRATION_CONCURRENCY = 10
+FUNDING_LOGS_USERS_PER_CALL = 100  # user topics per getLogs filter, since providers limit the size of filters
+RATE_LIMIT_BACKOFF = 1  # seconds, doubled after every rate-limited getLogs request of a window
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Errors of contract calls that fail the same way on every retry, e.g. decimals() of a token that is not an ERC20.
+# Products that hit them are skipped. Any other error fails the window, so that it is retried.
+PERMANENT_CALL_ERRORS = (ContractLogicError, BadFunctionCallOutput, DecodingError, UnicodeDecodeError)
+
 
 with open("abi/beaver_router.json", 'r') as f:
     BEAVER_ROUTER_ABI = json.loads(f.read())
@@ -31,6 +49,10 @@ with open("abi/erc20.json", 'r') as f:
     ERC20_ABI = json.loads(f.read())
 
 
+def address_to_topic(address: ChecksumAddress) -> HexStr:
+    return HexStr('0x' + address[2:].lower().rjust(64, '0'))
+
+
 class ChainIndexer:
     def __init__(
             self,
@@ -38,35 +60,61 @@ class ChainIndexer:
             router_address: ChecksumAddress,
             rpc: str,
             db: Database,
+            metadata_resolver: MetadataResolver,
+            price_oracle: PriceOracle,
             min_block: int,
             initiator_private_key: str,
-            needs_poa_middleware: bool
+            needs_poa_middleware: bool,
+            confirmations: int,
     ) -> None:
         self.chain = chain
         self.web3 = AsyncWeb3(AsyncHTTPProvider(rpc))
         if needs_poa_middleware:
             self.web3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
         self.db = db
+        self.metadata_resolver = metadata_resolver
+        self.price_oracle = price_oracle
+        self.fee_estimator = FeeEstimator(self.web3)
+        self.multicall = Multicall(self.web3)
+        self.call_cache = ImmutableCallCache(self.web3, self.db, self.chain)
+        self.erc20 = self.web3.eth.contract(abi=ERC20_ABI)  # For encoding calls to any token
         self.min_block = min_block
+        self.confirmations = confirmations
         self.router = self.web3.eth.contract(address=router_address, abi=BEAVER_ROUTER_ABI)
+        # Learned from the provider's responses and kept for the lifetime of the indexer
+        self.logs_block_range = AdaptiveBlockRange()
         self.account: LocalAccount = self.web3.eth.account.from_key(initiator_private_key)
+        self.nonce_manager = NonceManager(self.web3, self.account.address)
+        self.receipt_tracker = ReceiptTracker(self.web3)
+        # All router events are fetched with a single getLogs call and dispatched by topic0
+        self.router_events: dict[HexStr, AsyncContractEvent] = {
+            Web3.to_hex(event_abi_to_log_topic(event.abi)): event
+            for event in (
+                self.router.events.ProductCreated(),
+                self.router.events.SubscriptionStarted(),
+                self.router.events.PaymentMade(),
+                self.router.events.SubscriptionTerminated(),
+                self.router.events.InitiatorChanged(),
+            )
+        }
+        self.transfer_topic = Web3.to_hex(event_abi_to_log_topic(self.erc20.events.Transfer().abi))
+        self.approval_topic = Web3.to_hex(event_abi_to_log_topic(self.erc20.events.Approval().abi))
+        self.event_handlers: dict[str, Callable[[EventData, WriteBatch], Awaitable[None]]] = {
+            'ProductCreated': self.apply_product_created,
+            'SubscriptionStarted': self.apply_subscription_started,
+            'PaymentMade': self.apply_payment_made,
+            'SubscriptionTerminated': self.apply_subscription_terminated,
+            'InitiatorChanged': self.apply_initiator_changed,
+        }
         logging.info(f"Setup chain indexer. Chain: {self.chain.name}. Initiator: {self.account.address}. Router {self.router.address}")
     
-    def get_metadata_by_minimized_ipfs_cid(self, minimized_ipfs_cid: bytes, description: str) -> tuple[str, dict[str, Any] | None]:
-        ipfs_cid = base58.b58encode(IPFS_VERSION + minimized_ipfs_cid).decode(errors='replace')
+    async def get_metadata_by_minimized_ipfs_cid(self, minimized_ipfs_cid: bytes, description: str) -> tuple[str, dict[str, Any] | None]:
+        ipfs_cid = minimized_ipfs_cid_to_cid(minimized_ipfs_cid)
 
-        metadata = self.db.get_metadata_by_ipfs_cid(ipfs_cid)
+        metadata = await self.metadata_resolver.resolve(ipfs_cid)
         if metadata is None:
-            logging.info(f"No metadata was found in the database for minimized_ipfs_cid {minimized_ipfs_cid} for {description} for chain {self.chain.name} and router {self.router.address}. Will try to download it from IPFS.")
-        
-            response = requests.get(f'{PINATA_BASE_URL}/{ipfs_cid}')
-            if response.status_code != 200:
-                logging.error(f"No metadata was found on IPFS for minimized_ipfs_cid {minimized_ipfs_cid} for {description} for chain {self.chain.name} and router {self.router.address}.")
-                return '', None
-
-            metadata = response.text
-            self.db.store_metadata(ipfs_cid=ipfs_cid, content=metadata)
-            logging.info(f"Stored metadata in the database for ipfs CID {ipfs_cid} for {description} for chain {self.chain.name} and router {self.router.address}.")
+            logging.error(f"No metadata was found for minimized_ipfs_cid {minimized_ipfs_cid} for {description} for chain {self.chain.name} and router {self.router.address}.")
+            return '', None
 
         try:
             metadata_dict: dict = json.loads(metadata)
@@ -76,207 +124,384 @@ class ChainIndexer:
 
         return ipfs_cid, metadata_dict
 
-    async def discover_new_subscriptions(self):
-        last_checked_block = self.db.get_last_checked_subscriptions_block(self.chain, self.min_block)
-        latest_block = await self.web3.eth.block_number
-        logging.info(f"Starting a loop to check new subscription logs for chain {self.chain.name} and router {self.router.address} from block {last_checked_block + 1} to {latest_block}")
+    async def handle_reorg(self) -> bool:
+        """Rolls back the windows that were applied from blocks which are not on the canonical chain anymore.
+
+        Returns False if the node doesn't have all checkpointed blocks yet, in which case nothing can be decided.
+        """
+        checkpoints = await self.db.get_block_checkpoints(self.chain)
+        common_block: int | None = None
+        for checkpoint in checkpoints:
+            try:
+                block = await self.web3.eth.get_block(checkpoint.to_block)
+            except BlockNotFound:
+                # Load-balanced RPCs may route to a backend that lags a few blocks behind. Only a different hash means a reorg.
+                logging.warning(f"Node doesn't have checkpointed block {checkpoint.to_block} yet. Skipping this pass for chain {self.chain.name} and router {self.router.address}")
+                return False
+
+            if block['hash'].hex() == checkpoint.block_hash:
+                common_block = checkpoint.to_block
+                break
+
+        if len(checkpoints) == 0 or common_block == checkpoints[0].to_block:
+            return True
+
+        if common_block is None:
+            # Even the oldest checkpointed window was reorged, but the blocks before it are final
+            common_block = checkpoints[-1].from_block - 1
+
+        logging.warning(f"Detected a reorg after block {common_block}. Rolling back to it for chain {self.chain.name} and router {self.router.address}")
+        await self.db.rollback(self.chain, common_block)
+        return True
+
+    async def discover_new_events(self, latest_block: int | None = None):
+        if not await self.handle_reorg():
+            return
+
+        last_checked_block = await self.db.get_last_checked_block(self.chain, self.min_block)
+        if latest_block is None:
+            latest_block = await self.web3.eth.block_number
+        # Blocks after it may still be reorged, so they are applied with a checkpoint that allows to undo them
+        final_block = latest_block - self.confirmations
+        retry_watchlist = await self.db.get_retry_watchlist(self.chain, ts_now())
+        logging.info(f"Starting a loop to check new router logs for chain {self.chain.name} and router {self.router.address} from block {last_checked_block + 1} to {latest_block}")
         try:
-            for from_block in range(last_checked_block + 1, latest_block + 1, MAX_LOGS_BLOCK_RANGE):
-                to_block = min(from_block + MAX_LOGS_BLOCK_RANGE - 1, latest_block)
-                logging.info(f"Checking new subscription logs for chain {self.chain.name} and router {self.router.address} from block {from_block} to {to_block}")
-                new_logs = await self.router.events.SubscriptionStarted().get_logs(  # type: ignore
-                    fromBlock=from_block,
-                    toBlock=to_block,
-                )
-                for log in new_logs:
-                    logging.info(f"Found new subscription log for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
-                    subscription_hash = log.args.subscriptionHash.hex()
-                    product_hash_bytes = log.args.productHash
-                    product_hash_hex = product_hash_bytes.hex()
-                    user_address = log.args.user
-                    start_ts = log.args.start
-                    subscription_metadata_raw = log.args.subscriptionMetadata
-
-                    product = self.db.get_product_by_hash(product_hash_hex)
-                    if product is None:
-                        product_raw = await self.router.functions.products(product_hash_bytes).call()
-                        (
-                            uint_amount,
-                            token_address,
-                            period,
-                            free_trial_length,
-                            payment_period,
-                            merchant_address,
-                            product_metadata_raw,
-                        ) = product_raw
-
-                        initiator = await self.router.functions.merchantSettings(merchant_address).call()
-                        self.db.set_merchant_initiator(
-                            merchant_address=merchant_address,
-                            chain=self.chain,
-                            initiator=initiator,
-                        )
-                        logging.info(f"Set initiator to {initiator} for merchant {merchant_address} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
-
-                        token_contract = self.web3.eth.contract(address=token_address, abi=ERC20_ABI)
-                        token_decimals = await token_contract.functions.decimals().call()
-                        token_symbol = await token_contract.functions.symbol().call()
-
-                        product_metadata_full_ipfs_cid, product_metadata_dict = self.get_metadata_by_minimized_ipfs_cid(
-                            minimized_ipfs_cid=product_metadata_raw,
-                            description=f'Product {str(product_raw)}',
-                        )
-                        if product_metadata_dict is None:
-                            continue  # Error was already logged in get_metadata_by_ipfs_cid
-
-                        try:
-                            merchant_domain = product_metadata_dict['merchantDomain']
-                            product_name = product_metadata_dict['productName']
-                        except KeyError as e:
-                            logging.error(f"No {str(e)} was specified in metadata {product_metadata_dict} for new subscription log {log} for chain {self.chain.name} and router {self.router.address}")
-                            continue
-
-                        product = Product(
-                            product_hash=product_hash_hex,
-                            chain=self.chain,
-                            merchant_address=merchant_address,
-                            token_address=token_address,
-                            token_symbol=token_symbol,
-                            token_decimals=token_decimals,
-                            uint_amount=uint_amount,
-                            human_amount=uint_amount / 10 ** token_decimals,
-                            period=period,
-                            free_trial_length=free_trial_length,
-                            payment_period=payment_period,
-                            metadata_cid=product_metadata_full_ipfs_cid,
-                            merchant_domain=merchant_domain,
-                            product_name=product_name,
-                        )
-
-                        self.db.add_product(product)
-                        logging.info(f"Added product {product} for chain {self.chain.name} and router {self.router.address}")
-
-                    subscription_metadata_full_ipfs_cid, subscription_metadata_dict = self.get_metadata_by_minimized_ipfs_cid(
-                        minimized_ipfs_cid=subscription_metadata_raw,
-                        description=f'Subscription {str(subscription_hash)}',
+            from_block = last_checked_block + 1
+            rate_limit_retries = 0
+            while from_block <= latest_block:
+                to_block = self.logs_block_range.window_end(from_block, latest_block)
+                if from_block <= final_block:
+                    to_block = min(to_block, final_block)  # Final blocks don't need checkpoints
+
+                logging.info(f"Checking new router logs for chain {self.chain.name} and router {self.router.address} from block {from_block} to {to_block}")
+                started_at = time.monotonic()
+                checkpoint: BlockCheckpoint | None = None
+                if to_block > final_block:
+                    # Fetched before the logs, so that a reorg in between is detected by the next handle_reorg()
+                    try:
+                        block = await self.web3.eth.get_block(to_block)
+                    except BlockNotFound:
+                        # The head may come from a different node than this one, so only what this node has is checked in this pass
+                        node_block = await self.web3.eth.block_number
+                        logging.info(f"Node doesn't have block {to_block} yet, its latest block is {node_block}, for chain {self.chain.name} and router {self.router.address}")
+                        if not from_block <= node_block < to_block:
+                            break
+
+                        latest_block = node_block
+                        continue
+
+                    checkpoint = BlockCheckpoint(from_block=from_block, to_block=to_block, block_hash=block['hash'].hex())
+
+                try:
+                    raw_logs, funding_logs = await asyncio.gather(
+                        self.web3.eth.get_logs({
+                            'address': self.router.address,
+                            'fromBlock': from_block,
+                            'toBlock': to_block,
+                            'topics': [list(self.router_events.keys())],  # Any of the tracked events
+                        }),
+                        self.get_funding_logs(from_block, to_block, retry_watchlist),
                     )
-                    subscription_metadata_dict = subscription_metadata_dict or {}  # subscription metadata is optional
-
-                    subscription = Subscription(
-                        subscription_hash=subscription_hash,
-                        product=product,
-                        user_address=user_address,
-                        start_ts=start_ts,
-                        payments_made=0,
-                        terminated=False,
-                        metadata_cid=subscription_metadata_full_ipfs_cid,
-                        subscription_id=subscription_metadata_dict.get('subscriptionId'),
-                        user_id=subscription_metadata_dict.get('userId'),
-                    )
-                    
-                    self.db.add_subscription(subscription)
-                    logging.info(f"Added new subscription {subscription} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+                except Exception as e:
+                    if is_rate_limit_error(e) and rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                        delay = RATE_LIMIT_BACKOFF * 2 ** rate_limit_retries
+                        rate_limit_retries += 1
+                        logging.warning(f"Provider rate-limited getLogs for blocks {from_block}-{to_block}. Retrying in {delay} seconds for chain {self.chain.name} and router {self.router.address}. Error: {e}")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    if not is_range_error(e) or not self.logs_block_range.on_range_error():
+                        raise
+
+                    logging.warning(f"Provider rejected getLogs for blocks {from_block}-{to_block} for chain {self.chain.name} and router {self.router.address}. Reduced the range to {self.logs_block_range.size} blocks. Error: {e}")
+                    continue
+
+                rate_limit_retries = 0
+                self.logs_block_range.on_response(len(raw_logs) + len(funding_logs), time.monotonic() - started_at)
+
+                # Logs must be applied fully chronologically, e.g. a PaymentMade can't be applied before its SubscriptionStarted.
+                # All changes of the window are written in a single transaction together with the new cursor.
+                logs = [
+                    self.router_events[Web3.to_hex(raw_log['topics'][0])].process_log(raw_log)
+                    for raw_log in sorted(raw_logs, key=lambda log: (log['blockNumber'], log['logIndex']))
+                ]
+                batch = WriteBatch(chain=self.chain, last_checked_block=to_block, checkpoint=checkpoint)
+                await asyncio.gather(
+                    self.metadata_resolver.prefetch(
+                        minimized_ipfs_cid_to_cid(log.args.subscriptionMetadata)
+                        for log in logs if log.event == 'SubscriptionStarted'
+                    ),
+                    self.hydrate_products(logs, batch),
+                )
 
-                self.db.set_last_checked_subscriptions_block(self.chain, to_block)
-                logging.info(f"Finished checking new subscription logs for chain {self.chain.name} and router {self.router.address}")
-        except HTTPError:
-            # If we got an HTTP error - it's okay, we will check again later
-            logging.warning(f"Haven't checked all new subscription logs for chain {self.chain.name} and router {self.router.address} because of an HTTP error: {traceback.format_exc()}")
+                for log in logs:
+                    await self.event_handlers[log.event](log, batch)
+                self.apply_funding_logs(funding_logs, retry_watchlist, batch)
 
-    async def discover_new_payments(self):
-        last_checked_block = self.db.get_last_checked_payments_block(self.chain, self.min_block)
-        latest_block = await self.web3.eth.block_number
-        logging.info(f"Starting a loop to check new payment logs for chain {self.chain.name} and router {self.router.address} from block {last_checked_block + 1} to {latest_block}")
-        try:
-            for from_block in range(last_checked_block + 1, latest_block + 1, MAX_LOGS_BLOCK_RANGE):
-                to_block = min(from_block + MAX_LOGS_BLOCK_RANGE - 1, latest_block)
-                logging.info(f"Checking new payment logs for chain {self.chain.name} and router {self.router.address} from block {from_block} to {to_block}")
-                new_logs = await self.router.events.PaymentMade().get_logs(  # type: ignore
-                    fromBlock=from_block,
-                    toBlock=to_block,
-                )
-                for log in new_logs:
-                    self.db.update_payments_made(
-                        subscription_hash=log.args.subscriptionHash.hex(),
-                        new_payments_made=log.args.paymentNumber,
-                    )
-                    logging.info(f"Updated payments made for subscription (or ignored if subscription is not tracked) {log.args.subscriptionHash.hex()} to {log.args.paymentNumber} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
-                
-                self.db.set_last_checked_payments_block(self.chain, to_block)
-            
-            logging.info(f"Finished checking new payment logs for chain {self.chain.name} and router {self.router.address}")
-        except HTTPError:
-            # If we got an HTTP error - it's okay, we will check again later
-            logging.warning(f"Haven't checked all new payment logs for chain {self.chain.name} and router {self.router.address} because of an HTTP error: {traceback.format_exc()}")
+                await self.db.apply_write_batch(batch)
+                from_block = to_block + 1
 
-    async def discover_new_terminations(self):
-        last_checked_block = self.db.get_last_checked_terminations_block(self.chain, self.min_block)
-        latest_block = await self.web3.eth.block_number
-        logging.info(f"Starting a loop to check new termination logs for chain {self.chain.name} and router {self.router.address} from block {last_checked_block + 1} to {latest_block}")
-        try:
-            for from_block in range(last_checked_block + 1, latest_block + 1, MAX_LOGS_BLOCK_RANGE):
-                to_block = min(from_block + MAX_LOGS_BLOCK_RANGE - 1, latest_block)
-                logging.info(f"Checking new termination logs for chain {self.chain.name} and router {self.router.address} from block {from_block} to {to_block}")
-                new_logs = await self.router.events.SubscriptionTerminated().get_logs(  # type: ignore
-                    fromBlock=from_block,
-                    toBlock=to_block,
-                )
-                for log in new_logs:
-                    self.db.terminate_subscription(
-                        subscription_hash=log.args.subscriptionHash.hex(),
-                    )
-                    logging.info(f"Marked subscription {log.args.subscriptionHash.hex()} as terminated (or ignored if subscription is not tracked) for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
-                
-                self.db.set_last_checked_terminations_block(self.chain, to_block)
-            
-            logging.info(f"Finished checking new termination logs for chain {self.chain.name} and router {self.router.address}")
+            await self.db.prune_block_checkpoints(self.chain, final_block)
+            logging.info(f"Finished checking new router logs for chain {self.chain.name} and router {self.router.address}")
         except HTTPError:
             # If we got an HTTP error - it's okay, we will check again later
-            logging.warning(f"Haven't checked all new termination logs for chain {self.chain.name} and router {self.router.address} because of an HTTP error: {traceback.format_exc()}")
-    
-    async def discover_new_initiator_changes(self):
-        last_checked_block = self.db.get_last_checked_initiators_block(self.chain, self.min_block)
-        latest_block = await self.web3.eth.block_number
-        logging.info(f"Starting a loop to check new change initiator logs for chain {self.chain.name} and router {self.router.address} from block {last_checked_block + 1} to {latest_block}")
+            logging.warning(f"Haven't checked all new router logs for chain {self.chain.name} and router {self.router.address} because of an HTTP error: {traceback.format_exc()}")
+
+    async def get_funding_logs(self, from_block: int, to_block: int, watchlist: set[tuple[ChecksumAddress, ChecksumAddress]]) -> list[LogReceipt]:
+        """Token transfers to and router approvals by users whose payments wait for a retry. Either might have made their payments possible."""
+        if len(watchlist) == 0:
+            return []
+
+        token_addresses = sorted({token_address for token_address, _ in watchlist})
+        user_topics = sorted({address_to_topic(user_address) for _, user_address in watchlist})
+        filters: list[FilterParams] = []
+        for i in range(0, len(user_topics), FUNDING_LOGS_USERS_PER_CALL):
+            users_batch = user_topics[i:i + FUNDING_LOGS_USERS_PER_CALL]
+            filters.append({
+                'address': token_addresses,
+                'fromBlock': from_block,
+                'toBlock': to_block,
+                'topics': [self.transfer_topic, None, users_batch],  # Transfer(from, to, value) to one of the users
+            })
+            filters.append({
+                'address': token_addresses,
+                'fromBlock': from_block,
+                'toBlock': to_block,
+                'topics': [self.approval_topic, users_batch, address_to_topic(self.router.address)],  # Approval(owner, spender, value) of the router
+            })
+
+        results = await asyncio.gather(*[self.web3.eth.get_logs(log_filter) for log_filter in filters])
+        return [raw_log for raw_logs in results for raw_log in raw_logs]
+
+    def apply_funding_logs(self, raw_logs: list[LogReceipt], watchlist: set[tuple[ChecksumAddress, ChecksumAddress]], batch: WriteBatch):
+        for raw_log in raw_logs:
+            # The user is the recipient of a transfer and the owner of an approval
+            user_topic = raw_log['topics'][2] if Web3.to_hex(raw_log['topics'][0]) == self.transfer_topic else raw_log['topics'][1]
+            user_address = Web3.to_checksum_address(user_topic[-20:])
+            token_address = raw_log['address']
+            if (token_address, user_address) not in watchlist:
+                continue  # The same users may subscribe with other tokens
+
+            logging.info(f"Found a funding log of token {token_address} for user {user_address} at block {raw_log['blockNumber']}. Re-queueing their payments for chain {self.chain.name} and router {self.router.address}")
+            batch.requeue_payments(token_address=token_address, user_address=user_address)
+
+    async def get_token(self, token_address: ChecksumAddress) -> Token | None:
+        token = await self.db.get_token(self.chain, token_address)
+        if token is None:
+            token_contract = self.web3.eth.contract(address=token_address, abi=ERC20_ABI)
+            try:
+                decimals, symbol = await asyncio.gather(
+                    self.call_cache.call(token_contract, 'decimals'),
+                    self.call_cache.call(token_contract, 'symbol'),
+                )
+            except PERMANENT_CALL_ERRORS:
+                # Anyone can create a product, so the token may be an EOA or a contract that is not an ERC20
+                logging.error(f"Could not read decimals and symbol of token {token_address} for chain {self.chain.name} and router {self.router.address}: {traceback.format_exc()}")
+                return None
+
+            token = Token(chain=self.chain, address=token_address, symbol=symbol, decimals=decimals)
+            await self.db.add_token(token)
+            logging.info(f"Added token {token} for chain {self.chain.name} and router {self.router.address}")
+
+        return token
+
+    async def make_product(
+            self,
+            product_hash: str,
+            merchant_address: ChecksumAddress,
+            token_address: ChecksumAddress,
+            uint_amount: int,
+            period: int,
+            free_trial_length: int,
+            payment_period: int,
+            product_metadata_raw: bytes,
+            batch: WriteBatch,
+    ) -> Product | None:
+        # Initiators are tracked through InitiatorChanged, so the router is only asked about merchants we haven't seen yet
+        if merchant_address not in batch.merchant_initiators and await self.db.get_merchant_initiator(merchant_address, self.chain) is None:
+            initiator = await self.router.functions.merchantSettings(merchant_address).call()
+            batch.set_merchant_initiator(
+                merchant_address=merchant_address,
+                initiator=initiator,
+            )
+            logging.info(f"Set initiator to {initiator} for merchant {merchant_address} for chain {self.chain.name} and router {self.router.address}")
+
+        token = await self.get_token(token_address)
+        if token is None:
+            return None  # Error was already logged in get_token
+
+        product_metadata_full_ipfs_cid, product_metadata_dict = await self.get_metadata_by_minimized_ipfs_cid(
+            minimized_ipfs_cid=product_metadata_raw,
+            description=f'Product {product_hash}',
+        )
+        if product_metadata_dict is None:
+            return None  # Error was already logged in get_metadata_by_ipfs_cid
+
         try:
-            for from_block in range(last_checked_block + 1, latest_block + 1, MAX_LOGS_BLOCK_RANGE):
-                to_block = min(from_block + MAX_LOGS_BLOCK_RANGE - 1, latest_block)
-                logging.info(f"Checking new change initiator logs for chain {self.chain.name} and router {self.router.address} from block {from_block} to {to_block}")
-                new_logs = await self.router.events.InitiatorChanged().get_logs(  # type: ignore
-                    fromBlock=from_block,
-                    toBlock=to_block,
+            merchant_domain = product_metadata_dict['merchantDomain']
+            product_name = product_metadata_dict['productName']
+        except KeyError as e:
+            logging.error(f"No {str(e)} was specified in metadata {product_metadata_dict} for product {product_hash} for chain {self.chain.name} and router {self.router.address}")
+            return None
+
+        return Product(
+            product_hash=product_hash,
+            chain=self.chain,
+            merchant_address=merchant_address,
+            token_address=token_address,
+            token_symbol=token.symbol,
+            token_decimals=token.decimals,
+            uint_amount=uint_amount,
+            human_amount=uint_amount / 10 ** token.decimals,
+            period=period,
+            free_trial_length=free_trial_length,
+            payment_period=payment_period,
+            metadata_cid=product_metadata_full_ipfs_cid,
+            merchant_domain=merchant_domain,
+            product_name=product_name,
+        )
+
+    async def fetch_product(self, product_hash_bytes: bytes, batch: WriteBatch) -> Product | None:
+        (
+            uint_amount,
+            token_address,
+            period,
+            free_trial_length,
+            payment_period,
+            merchant_address,
+            product_metadata_raw,
+        ) = await self.call_cache.call(self.router, 'products', product_hash_bytes)
+        return await self.make_product(
+            product_hash=product_hash_bytes.hex(),
+            merchant_address=merchant_address,
+            token_address=token_address,
+            uint_amount=uint_amount,
+            period=period,
+            free_trial_length=free_trial_length,
+            payment_period=payment_period,
+            product_metadata_raw=product_metadata_raw,
+            batch=batch,
+        )
+
+    async def hydrate_products(self, logs: list[EventData], batch: WriteBatch):
+        """Builds all products that the logs of a window need concurrently, before the logs are applied one by one."""
+        semaphore = asyncio.Semaphore(PRODUCT_HYDRATION_CONCURRENCY)
+
+        async def isolated(product_hash_bytes: bytes, hydration: Awaitable[Product | None]) -> Product | None:
+            # A broken product only skips its own subscriptions. JSON-RPC errors of a lagging or rate-limiting node are raised as
+            # plain ValueErrors and must not drop valid products, so only errors that are known to be permanent are isolated.
+            try:
+                return await hydration
+            except PERMANENT_CALL_ERRORS:
+                logging.error(f"Could not hydrate product {product_hash_bytes.hex()} for chain {self.chain.name} and router {self.router.address}: {traceback.format_exc()}")
+                return None
+
+        async def hydrate_created_product(log: EventData) -> Product | None:
+            async with semaphore:
+                return await self.make_product(
+                    product_hash=log.args.productHash.hex(),
+                    merchant_address=log.args.merchant,
+                    token_address=log.args.token,
+                    uint_amount=log.args.amount,
+                    period=log.args.period,
+                    free_trial_length=log.args.freeTrialLength,
+                    payment_period=log.args.paymentPeriod,
+                    product_metadata_raw=log.args.productMetadata,
+                    batch=batch,
                 )
-                for log in new_logs:
-                    merchant: ChecksumAddress = log.args.merchant
-                    new_initiator: ChecksumAddress = log.args.newInitiator
-                    self.db.set_merchant_initiator(
-                        merchant_address=merchant,
-                        chain=self.chain,
-                        initiator=new_initiator,
-                    )
-                    logging.info(f"Set initiator to {new_initiator} for merchant {merchant} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
-                
-                self.db.set_last_checked_initiators_block(self.chain, to_block)
-            
-            logging.info(f"Finished checking new change initiator logs for chain {self.chain.name} and router {self.router.address}")
-        except HTTPError:
-            # If we got an HTTP error - it's okay, we will check again later
-            logging.warning(f"Haven't checked all change initiator logs for chain {self.chain.name} and router {self.router.address} because of an HTTP error: {traceback.format_exc()}")
-    
-    async def calculate_gas_params(self, token_address: ChecksumAddress, gas: int) -> tuple[Wei, Wei, float]:
-        """Returns maxFeePerGas, maxPriorityFee and compensation in token to use for the specified amount of gas for a transaction executed right now."""
-        token_to_eth_price = get_token_to_eth_price(chain=self.chain, token_address=token_address)
-        
-        latest_block = await self.web3.eth.get_block('latest')
-        latest_base_fee = latest_block.get('baseFeePerGas')
-        if latest_base_fee is None:
-            raise AssertionError(f'Latest base fee was None for block {latest_block} at timestamp {ts_now()}!!!!!!!!!!!!!')
+
+        async def hydrate_subscribed_product(product_hash_bytes: bytes) -> Product | None:
+            async with semaphore:
+                if await self.db.get_product_by_hash(product_hash_bytes.hex()) is not None:
+                    return None  # Already indexed
+
+                # Products are indexed from ProductCreated, unless they were created before min_block
+                return await self.fetch_product(product_hash_bytes, batch)
+
+        created_products = {log.args.productHash: log for log in logs if log.event == 'ProductCreated'}
+        subscribed_products = {log.args.productHash for log in logs if log.event == 'SubscriptionStarted'} - created_products.keys()
+        products = await asyncio.gather(
+            *[isolated(log.args.productHash, hydrate_created_product(log)) for log in created_products.values()],
+            *[isolated(product_hash_bytes, hydrate_subscribed_product(product_hash_bytes)) for product_hash_bytes in subscribed_products],
+        )
+
+        for product in products:
+            if product is not None:
+                batch.add_product(product)
+
+    async def apply_product_created(self, log: EventData, batch: WriteBatch):
+        product = batch.products.get(log.args.productHash.hex())
+        if product is None:
+            return  # The error was already logged by hydrate_products
+
+        logging.info(f"Added product {product} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+
+    async def apply_subscription_started(self, log: EventData, batch: WriteBatch):
+        logging.info(f"Found new subscription log for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+        subscription_hash = log.args.subscriptionHash.hex()
+        product_hash_hex = log.args.productHash.hex()
+        user_address = log.args.user
+        start_ts = log.args.start
+        subscription_metadata_raw = log.args.subscriptionMetadata
+
+        # Products of the window were hydrated by hydrate_products
+        product = batch.products.get(product_hash_hex) or await self.db.get_product_by_hash(product_hash_hex)
+        if product is None:
+            logging.error(f"Skipping subscription {subscription_hash} of product {product_hash_hex}, which could not be hydrated, for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+            return
+
+        subscription_metadata_full_ipfs_cid, subscription_metadata_dict = await self.get_metadata_by_minimized_ipfs_cid(
+            minimized_ipfs_cid=subscription_metadata_raw,
+            description=f'Subscription {str(subscription_hash)}',
+        )
+        subscription_metadata_dict = subscription_metadata_dict or {}  # subscription metadata is optional
+
+        subscription = Subscription(
+            subscription_hash=subscription_hash,
+            product=product,
+            user_address=user_address,
+            start_ts=start_ts,
+            payments_made=0,
+            terminated=False,
+            metadata_cid=subscription_metadata_full_ipfs_cid,
+            subscription_id=subscription_metadata_dict.get('subscriptionId'),
+            user_id=subscription_metadata_dict.get('userId'),
+        )
+
+        batch.add_subscription(subscription)
+        logging.info(f"Added new subscription {subscription} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+
+    async def apply_payment_made(self, log: EventData, batch: WriteBatch):
+        batch.update_payments_made(
+            subscription_hash=log.args.subscriptionHash.hex(),
+            new_payments_made=log.args.paymentNumber,
+        )
+        logging.info(f"Updated payments made for subscription (or ignored if subscription is not tracked) {log.args.subscriptionHash.hex()} to {log.args.paymentNumber} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+
+    async def apply_subscription_terminated(self, log: EventData, batch: WriteBatch):
+        batch.terminate_subscription(
+            subscription_hash=log.args.subscriptionHash.hex(),
+        )
+        logging.info(f"Marked subscription {log.args.subscriptionHash.hex()} as terminated (or ignored if subscription is not tracked) for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+
+    async def apply_initiator_changed(self, log: EventData, batch: WriteBatch):
+        merchant: ChecksumAddress = log.args.merchant
+        new_initiator: ChecksumAddress = log.args.newInitiator
+        batch.set_merchant_initiator(
+            merchant_address=merchant,
+            initiator=new_initiator,
+        )
+        logging.info(f"Set initiator to {new_initiator} for merchant {merchant} for chain {self.chain.name} and router {self.router.address} at block {log.blockNumber}")
+
+    async def calculate_gas_params(self, token_address: ChecksumAddress, gas: int, block_number: int) -> tuple[Wei, Wei, float]:
+        """Returns maxFeePerGas, maxPriorityFee and compensation in token to use for the specified amount of gas for a transaction executed right after block_number."""
+        token_to_eth_price = await self.price_oracle.get_token_to_eth_price(chain=self.chain, token_address=token_address)
         
-        latest_priority_fee = await self.web3.eth.max_priority_fee
+        fee_snapshot = await self.fee_estimator.get_snapshot(block_number)
         # multiplying by 1.2 to get some reserve against fee fluctionations
-        base_fee_to_use = Wei(int(latest_base_fee * 1.2))
+        base_fee_to_use = Wei(int(fee_snapshot.next_base_fee * 1.2))
         # multiplying by 1.1 to have better chances of transaction inclusion than average
-        priority_fee_to_use = Wei(int(latest_priority_fee * 1.1))
+        priority_fee_to_use = Wei(int(fee_snapshot.priority_fee * 1.1))
 
         max_fee_wei = Wei(base_fee_to_use + priority_fee_to_use)
         eth_fee = gas * max_fee_wei / 1e18
@@ -288,47 +513,138 @@ class ChainIndexer:
         
         return max_fee_wei, priority_fee_to_use, compensation_in_token
 
-    async def pay_payable_subscriptions(self):
-        logging.info(f'Checking payable subscriptions on chain {self.chain.name} and router {self.router.address}')
-        if not self.db.get_initiator_available(self.chain):
-            logging.critical(f'The initiator is stuck on chain {self.chain.name} and router {self.router.address}!')
-            return  # The initiator is stuck. Needs to be resolved manually ASAP!!!
-
-        payable_subscriptions = self.db.get_payable_subscriptions(self.chain, ts_now(), self.account.address)
-        logging.info(f'Got {len(payable_subscriptions)} subscriptions to attempt payments for on chain {self.chain.name} and router {self.router.address}')
-        for subscription in payable_subscriptions:
-            payment_number = subscription.payments_made + 1
-            logging.info(f'Attempting payment {payment_number} for subscription {subscription} on chain {self.chain.name} and router {self.router.address}')
+    async def filter_fundable_subscriptions(self, subscriptions: list[Subscription]) -> list[Subscription]:
+        """Returns subscriptions whose users have enough balance and allowance for the payment. Issues are logged for the rest."""
+        # Balances and allowances of all (token, user) pairs are fetched with a few multicalls instead of two eth_calls per subscription
+        pairs = list({(subscription.product.token_address, subscription.user_address) for subscription in subscriptions})
+        calls: list[Call] = []
+        for token_address, user_address in pairs:
+            calls.append(Call(token_address, self.erc20.encodeABI(fn_name='balanceOf', args=[user_address]), ['uint256']))
+            calls.append(Call(token_address, self.erc20.encodeABI(fn_name='allowance', args=[user_address, self.router.address]), ['uint256']))
+        results = await self.multicall.call(calls)
+
+        # Several subscriptions of the same user in the same token are paid from the same balance and allowance
+        balances: dict[tuple[ChecksumAddress, ChecksumAddress], int | None] = {}
+        allowances: dict[tuple[ChecksumAddress, ChecksumAddress], int | None] = {}
+        for i, pair in enumerate(pairs):
+            balance_result, allowance_result = results[2 * i], results[2 * i + 1]
+            balances[pair] = balance_result[0] if balance_result is not None else None
+            allowances[pair] = allowance_result[0] if allowance_result is not None else None
+
+        fundable_subscriptions: list[Subscription] = []
+        issue_logs: list[SubscriptionLog] = []
+        for subscription in subscriptions:
+            pair = (subscription.product.token_address, subscription.user_address)
+            user_balance_uint = balances[pair]
+            allowance_uint = allowances[pair]
+            token_units = 10 ** subscription.product.token_decimals
+            if user_balance_uint is None or allowance_uint is None:
+                issue = f'could not read balance and allowance of token {subscription.product.token_address}.'
+            elif user_balance_uint < subscription.product.uint_amount:
+                issue = f'user only has {user_balance_uint / token_units} tokens while {subscription.product.human_amount} is required to make a payment.'
+            elif allowance_uint < subscription.product.uint_amount:
+                issue = f'allowance is only {allowance_uint / token_units} tokens while {subscription.product.human_amount} is required to make a payment.'
+            else:
+                balances[pair] = user_balance_uint - subscription.product.uint_amount
+                allowances[pair] = allowance_uint - subscription.product.uint_amount
+                fundable_subscriptions.append(subscription)
+                continue
 
-            token_contract = self.web3.eth.contract(address=subscription.product.token_address, abi=ERC20_ABI)
-            user_balance_uint = await token_contract.functions.balanceOf(subscription.user_address).call()
-            if user_balance_uint < subscription.product.uint_amount:
-                logging.error(f"Error while attempting payment for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address}: user only has {user_balance_uint / 10 ** subscription.product.token_decimals} tokens while {subscription.product.human_amount} is required to make a payment.")
-                # TODO: notify merchant and user about the problem.
-                self.db.add_subscription_log(SubscriptionLog(
+            logging.error(f"Error while attempting payment for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address}: {issue}")
+            # TODO: notify merchant and user about the problem.
+            issue_logs.append(SubscriptionLog(
+                log_id=-1,  # assigned at the db level
+                log_type='payment-issue',
+                subscription_hash=subscription.subscription_hash,
+                payment_number=subscription.payments_made + 1,
+                message=f'Could not pay the subscription due to: {issue}',
+                timestamp=ts_now(),
+            ))
+
+        await self.db.add_subscription_logs(issue_logs)
+        logging.info(f'{len(fundable_subscriptions)} out of {len(subscriptions)} payable subscriptions have enough balance and allowance on chain {self.chain.name} and router {self.router.address}')
+        return fundable_subscriptions
+
+    async def confirm_payments(self) -> bool:
+        """Processes receipts of the sent payments. Returns False if the initiator got stuck."""
+        if len(self.receipt_tracker) == 0:
+            return True
+
+        for payment, tx_receipt in await self.receipt_tracker.poll():
+            subscription = payment.subscription
+            logging.info(f"Payment tx {payment.tx_hash.hex()} for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address} has been added to a block!")
+            if tx_receipt['status'] != 1:
+                logging.error(f"Payment tx {payment.tx_hash.hex()} for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address} has failed.")
+                await self.db.add_subscription_log(SubscriptionLog(
                     log_id=-1,  # assigned at the db level
                     log_type='payment-issue',
                     subscription_hash=subscription.subscription_hash,
-                    payment_number=payment_number,
-                    message=f'Could not pay the subscription due to: user only has {user_balance_uint / 10 ** subscription.product.token_decimals} tokens while {subscription.product.human_amount} is required to make a payment.',
+                    payment_number=payment.payment_number,
+                    message=f'Could not pay the subscription due to: payment transaction {payment.tx_hash.hex()} has failed.',
                     timestamp=ts_now(),
                 ))
                 continue
 
-            allowance_uint = await token_contract.functions.allowance(subscription.user_address, self.router.address).call()
-            if allowance_uint < subscription.product.uint_amount:
-                logging.error(f"Error while attempting payment for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address}: allowance is onlt {user_balance_uint / 10 ** subscription.product.token_decimals} tokens while {subscription.product.human_amount} is required to make a payment.")
-                # TODO: notify merchant and user about the problem.
-                self.db.add_subscription_log(SubscriptionLog(
-                    log_id=-1,  # assigned at the db level
-                    log_type='payment-issue',
-                    subscription_hash=subscription.subscription_hash,
-                    payment_number=payment_number,
-                    message=f'Could not pay the subscription due to: allowance is only {allowance_uint / 10 ** subscription.product.token_decimals} tokens while {subscription.product.human_amount} is required to make a payment.',
-                    timestamp=ts_now(),
-                ))
+            # Only the PaymentMade emitted by our router for this subscription counts. Payments of other initiators may be in the same block.
+            new_payment_logs = [
+                log for log in self.router.events.PaymentMade().process_receipt(tx_receipt, errors=DISCARD)
+                if log.address == self.router.address and log.args.subscriptionHash.hex() == subscription.subscription_hash
+            ]
+            if len(new_payment_logs) != 1:
+                logging.error(f'After making a payment in tx {payment.tx_hash.hex()} on chain {self.chain.name} and router {self.router.address}, found payment logs {new_payment_logs} in the receipt, while expected to find exactly one payment log.')
                 continue
 
+            actual_payment_number = new_payment_logs[0].args.paymentNumber
+
+            await self.db.update_payments_made(subscription.subscription_hash, actual_payment_number)
+            await self.db.add_subscription_log(SubscriptionLog(
+                log_id=-1,  # assigned at the db level
+                log_type='payment-made',
+                subscription_hash=subscription.subscription_hash,
+                payment_number=actual_payment_number,
+                message='',  # No need to put anything
+                timestamp=ts_now(),
+            ))
+
+        oldest_sent_at = self.receipt_tracker.oldest_sent_at()
+        if oldest_sent_at is not None and ts_now() - oldest_sent_at > PAYMENT_RECEIPT_TIMEOUT:
+            logging.critical(f"A payment tx for chain {self.chain.name} and router {self.router.address} has not been added to a block for {PAYMENT_RECEIPT_TIMEOUT} seconds. We are stuck!!! Need to resolve this ASAP to continue making payments!!!!!")
+            await self.db.disable_initiator(self.chain)
+            return False
+
+        return True
+
+    async def pay_payable_subscriptions(self):
+        logging.info(f'Checking payable subscriptions on chain {self.chain.name} and router {self.router.address}')
+        if not await self.db.get_initiator_available(self.chain):
+            logging.critical(f'The initiator is stuck on chain {self.chain.name} and router {self.router.address}!')
+            return  # The initiator is stuck. Needs to be resolved manually ASAP!!!
+
+        if not await self.confirm_payments():
+            return
+
+        # Pending payments are still due in the database, so fetching MAX_PENDING_PAYMENTS leaves enough for the free slots
+        payable_subscriptions = await self.db.get_payable_subscriptions(self.chain, ts_now(), self.account.address, limit=MAX_PENDING_PAYMENTS)
+        # Payments that were sent but are not confirmed yet must not be sent again
+        payable_subscriptions = [
+            subscription for subscription in payable_subscriptions
+            if not self.receipt_tracker.is_pending(subscription.subscription_hash)
+        ][:max(MAX_PENDING_PAYMENTS - len(self.receipt_tracker), 0)]
+        logging.info(f'Got {len(payable_subscriptions)} subscriptions to attempt payments for on chain {self.chain.name} and router {self.router.address}')
+        if len(payable_subscriptions) == 0:
+            return
+
+        payable_subscriptions = await self.filter_fundable_subscriptions(payable_subscriptions)
+        if len(payable_subscriptions) == 0:
+            return
+
+        # Fee estimates only change once per block, so all payments of this pass share them
+        latest_block = await self.web3.eth.block_number
+        # Payments are sent back to back with locally assigned nonces. Their receipts are checked in bulk on the next passes.
+        for subscription in payable_subscriptions:
+            payment_number = subscription.payments_made + 1
+            logging.info(f'Attempting payment {payment_number} for subscription {subscription} on chain {self.chain.name} and router {self.router.address}')
+
             # First payment is always made at the subscription setup
             if payment_number == 2:
                 gas = SECOND_PAYMENT_GAS
@@ -337,27 +653,38 @@ class ChainIndexer:
             max_fee_wei, priority_fee_wei, compensation_amount = await self.calculate_gas_params(
                 token_address=subscription.product.token_address,
                 gas=gas,
+                block_number=latest_block,
             )
             try:
-                nonce = await self.web3.eth.get_transaction_count(self.account.address)
-                tx_data = await self.router.functions.makePayment(
-                    bytes.fromhex(subscription.subscription_hash),
-                    int(compensation_amount * 10 ** subscription.product.token_decimals),
-                ).build_transaction({
-                    'from': self.account.address,
-                    'nonce': nonce,
+                nonce = await self.nonce_manager.next_nonce()
+            except Exception:
+                logging.error(f"Could not get a nonce for chain {self.chain.name} and router {self.router.address}: {traceback.format_exc()}")
+                return
+
+            try:
+                tx_data: TxParams = {
+                    'chainId': self.chain.value,
+                    'to': self.router.address,
+                    'data': self.router.encodeABI(fn_name='makePayment', args=[
+                        bytes.fromhex(subscription.subscription_hash),
+                        int(compensation_amount * 10 ** subscription.product.token_decimals),
+                    ]),
+                    'value': Wei(0),
+                    'nonce': Nonce(nonce),
                     'maxPriorityFeePerGas': priority_fee_wei,
                     'maxFeePerGas': max_fee_wei,
                     'gas': gas,
-                })
-                print('tx_data', tx_data)
-                signed_txn = self.account.sign_transaction(tx_data)
+                }
+                # Signing is CPU-bound, so it's kept off the event loop
+                signed_txn = await asyncio.to_thread(self.account.sign_transaction, tx_data)
                 tx_hash = await self.web3.eth.send_raw_transaction(signed_txn.rawTransaction)
-                logging.info(f'Sent the payment tx with hash {tx_hash} to pay for subscription {subscription.subscription_hash} on chain {self.chain.name} and router {self.router.address}')
+                logging.info(f'Sent the payment tx with hash {tx_hash.hex()} and nonce {nonce} to pay for subscription {subscription.subscription_hash} on chain {self.chain.name} and router {self.router.address}')
             except Exception:
+                # The nonce wasn't used, so the following ones must be re-synced with the node to avoid a gap
+                self.nonce_manager.reset()
                 logging.error(f"Error while attempting payment for subscription {subscription.subscription_hash} for chain {self.chain.name} and router {self.router.address}: {traceback.format_exc()}")
                 # TODO: notify merchant and user about the problem.
-                self.db.add_subscription_log(SubscriptionLog(
+                await self.db.add_subscription_log(SubscriptionLog(
                     log_id=-1,  # assigned at the db level
                     log_type='payment-issue',
                     subscription_hash=subscription.subscription_hash,
@@ -367,33 +694,10 @@ class ChainIndexer:
                 ))
                 continue
 
-            try:
-                tx_receipt = await self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-            except TimeExhausted:
-                logging.critical(f"Payment tx {tx_hash} for chain {self.chain.name} and router {self.router.address} has not been added to a block yet. We are stuck!!! Need to resolve this ASAP to continue making payments!!!!!")
-                self.db.disable_initiator(self.chain)
-                return
-            else:
-                logging.info(f"Payment tx {tx_hash} for chain {self.chain.name} and router {self.router.address} has been added to a block! We are good to go to make further payments!")
-                payment_tx_block = tx_receipt.get('blockNumber')
-                new_payment_logs = await self.router.events.PaymentMade().get_logs(  # type: ignore
-                    fromBlock=payment_tx_block,
-                    toBlock=payment_tx_block,
-                )
-                # TODO: change and check logs in the transaction. If multiple initiators work concurrently, this will fail.
-                if len(new_payment_logs) != 1:
-                    logging.error(f'After making a payment in tx {tx_hash} on chain {self.chain.name} and router {self.router.address}, in the transaction block {payment_tx_block} found payment logs {new_payment_logs}, while expected to find exactly one payment log.')
-                    continue    
-
-                payment_log = new_payment_logs[0]     
-                actual_payment_number = payment_log.args.paymentNumber
-
-                self.db.update_payments_made(subscription.subscription_hash, actual_payment_number)
-                self.db.add_subscription_log(SubscriptionLog(
-                    log_id=-1,  # assigned at the db level
-                    log_type='payment-made',
-                    subscription_hash=subscription.subscription_hash,
-                    payment_number=actual_payment_number,
-                    message='',  # No need to put anything
-                    timestamp=ts_now(),
-                ))
+            self.receipt_tracker.add(PendingPayment(
+                tx_hash=tx_hash,
+                subscription=subscription,
+                payment_number=payment_number,
+                nonce=nonce,
+                sent_at=ts_now(),
+            ))
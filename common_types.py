@@ -129,6 +129,33 @@ class Product(NamedTuple):
         )
 
 
+class Token(NamedTuple):
+    chain: Chain
+    address: ChecksumAddress
+    symbol: str
+    decimals: int
+
+    def to_db(self) -> dict[str, Any]:
+        return {
+            'chain': str(self.chain),
+            'address': self.address,
+            'symbol': self.symbol,
+            'decimals': self.decimals,
+        }
+
+    @staticmethod
+    def from_db(row: tuple) -> 'Token':
+        return Token(
+            chain=Chain.load(row[0]),
+            address=row[1],
+            symbol=row[2],
+            decimals=row[3],
+        )
+
+
+SubscriptionStatus = Literal['terminated', 'expired', 'pending', 'paid']
+
+
 class Subscription(NamedTuple):
     subscription_hash: HexStr
     product: Product
@@ -145,7 +172,7 @@ class Subscription(NamedTuple):
         return self.start_ts + self.product.period * self.payments_made
 
     @property
-    def status(self) -> str:
+    def status(self) -> SubscriptionStatus:
         if self.terminated:
             return 'terminated'
         
@@ -198,6 +225,7 @@ class Subscription(NamedTuple):
             'metadata_cid': self.metadata_cid,
             'subscription_id': self.subscription_id,
             'user_id': self.user_id,
+            'next_payment_at': self.next_payment_at,
         }
 
     @staticmethod
@@ -221,6 +249,9 @@ class ChainConfig(NamedTuple):
     rpc: str
     min_block: int
     needs_poa_middleware: bool
+    poll_interval: int  # seconds between indexing passes, roughly the chain's block time
+    confirmations: int  # blocks after which a block is considered final, i.e. can't be reorged anymore
+    ws_rpc: str | None  # for newHeads subscriptions. Without it, new blocks are polled for.
 
 
 SubscriptionActionType = Literal["payment-issue", "payment-made"]
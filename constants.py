@@ -11,6 +11,9 @@ SEPOLIA_CONFIG = ChainConfig(
   min_block=4642995,
   rpc='https://eth-sepolia-public.unifra.io',
   needs_poa_middleware=False,
+  poll_interval=12,
+  confirmations=12,
+  ws_rpc=os.environ.get('SEPOLIA_WS_RPC'),
 )
 
 MUMBAI_CONFIG = ChainConfig(
@@ -19,6 +22,9 @@ MUMBAI_CONFIG = ChainConfig(
   min_block=42085814,
   rpc='https://rpc.ankr.com/polygon_mumbai',
   needs_poa_middleware=True,
+  poll_interval=4,
+  confirmations=64,
+  ws_rpc=os.environ.get('MUMBAI_WS_RPC'),
 )
 
 BASE_GOERLI_CONFIG = ChainConfig(
@@ -27,6 +33,9 @@ BASE_GOERLI_CONFIG = ChainConfig(
   min_block=12051590,
   rpc='https://goerli.base.org',
   needs_poa_middleware=True,
+  poll_interval=4,
+  confirmations=30,
+  ws_rpc=os.environ.get('BASE_GOERLI_WS_RPC'),
 )
 
 POLYGON_CONFIG = ChainConfig(
@@ -35,6 +44,9 @@ POLYGON_CONFIG = ChainConfig(
   min_block=49624479,
   rpc='https://polygon.llamarpc.com',
   needs_poa_middleware=True,
+  poll_interval=4,
+  confirmations=64,
+  ws_rpc=os.environ.get('POLYGON_WS_RPC'),
 )
 
 BASE_CONFIG = ChainConfig(
@@ -43,6 +55,9 @@ BASE_CONFIG = ChainConfig(
   min_block=6255026,
   rpc='https://mainnet.base.org',
   needs_poa_middleware=True,
+  poll_interval=4,
+  confirmations=30,
+  ws_rpc=os.environ.get('BASE_WS_RPC'),
 )
 
 
@@ -1,298 +1,784 @@
+import asyncio
 import json
-from typing import Any
+import logging
+import os
+from typing import Any, AsyncIterator, NamedTuple, Sequence
 from eth_typing import ChecksumAddress
-import psycopg2
-from contextlib import contextmanager
-from threading import Lock
+from contextlib import asynccontextmanager
+from psycopg import AsyncClientCursor, AsyncCursor
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
 
-from common_types import Chain, Product, Subscription, SubscriptionLog
+from common_types import Chain, Product, Subscription, SubscriptionLog, SubscriptionStatus, Token
+from entitlements import EntitlementIndex
+from utils import LRUCache, ts_now
 
-with open('db_schema.sql') as f:
-    DB_SCHEMA = f.read()
+MIGRATIONS_DIR = 'migrations'
+MIGRATIONS_LOCK_ID = 1  # pg advisory lock taken while migrating, so that concurrently starting processes don't race
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+
+
+def load_migrations() -> list[Migration]:
+    """Migrations are forward-only sql files named <version>_<name>.sql and applied in the order of versions."""
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        if not file_name.endswith('.sql'):
+            continue
+
+        with open(os.path.join(MIGRATIONS_DIR, file_name)) as f:
+            migrations.append(Migration(
+                version=int(file_name.split('_', 1)[0]),
+                name=file_name.removesuffix('.sql'),
+                sql=f.read(),
+            ))
+
+    return sorted(migrations)
+
+
+MIGRATIONS = load_migrations()
+
+PRODUCT_CACHE_SIZE = 10000
+MERCHANT_CACHE_SIZE = 10000
+TOKEN_CACHE_SIZE = 1000
+
+# Explicit column lists in the order expected by Product.from_db and Subscription.from_db
+PRODUCT_COLUMNS = [
+    'hash',
+    'chain',
+    'merchant_address',
+    'token_address',
+    'token_symbol',
+    'token_decimals',
+    'uint_amount',
+    'human_amount',
+    'period',
+    'free_trial_length',
+    'payment_period',
+    'metadata_cid',
+    'merchant_domain',
+    'product_name',
+]
+SUBSCRIPTION_COLUMNS = [
+    'hash',
+    'product_hash',
+    'user_address',
+    'start_ts',
+    'payments_made',
+    'terminated',
+    'metadata_cid',
+    'subscription_id',
+    'user_id',
+]
+SELECT_SUBSCRIPTIONS_SQL = (
+    f'SELECT {", ".join(f"subscription.{column}" for column in SUBSCRIPTION_COLUMNS)}, {", ".join(f"product.{column}" for column in PRODUCT_COLUMNS)} '
+    'FROM subscription INNER JOIN product ON subscription.product_hash = product.hash'
+)
+SUBSCRIPTIONS_BY_MERCHANT_AND_USER_SQL = f'{SELECT_SUBSCRIPTIONS_SQL} WHERE product.merchant_domain = %s AND subscription.user_id = %s'
+SUBSCRIPTION_BY_MERCHANT_AND_SUBSCRIPTIONID_SQL = f'{SELECT_SUBSCRIPTIONS_SQL} WHERE product.merchant_domain = %s AND subscription.subscription_id = %s ORDER BY subscription.start_ts LIMIT 1'
+SUBSCRIPTION_BY_HASH_SQL = f'{SELECT_SUBSCRIPTIONS_SQL} WHERE subscription.hash = %s'
+# Both use the partial index on the due time, so that a scheduler tick only reads subscriptions of its chain that are due
+LAPSE_SUBSCRIPTIONS_SQL = '''UPDATE subscription SET lapsed = TRUE FROM product WHERE
+    product.hash = subscription.product_hash AND
+    terminated = FALSE AND lapsed = FALSE AND
+    GREATEST(next_payment_at, next_retry_at) <= %(timestamp)s AND
+    next_payment_at + product.payment_period <= %(timestamp)s AND
+    product.chain = %(chain)s
+'''
+PAYABLE_SUBSCRIPTIONS_SQL = f'''{SELECT_SUBSCRIPTIONS_SQL} INNER JOIN merchant ON product.merchant_address = merchant.address AND product.chain = merchant.chain WHERE
+    terminated = FALSE AND lapsed = FALSE AND
+    GREATEST(next_payment_at, next_retry_at) <= %(timestamp)s AND
+    next_payment_at + product.payment_period > %(timestamp)s AND
+    product.chain = %(chain)s AND
+    initiator = %(initiator)s
+    ORDER BY GREATEST(next_payment_at, next_retry_at)
+    LIMIT %(limit)s
+'''
+
+SUBSCRIPTIONS_STREAM_BATCH_SIZE = 500  # rows fetched at once from a server-side cursor
+MAX_CONCURRENT_STREAMS = 4  # Each stream holds a pooled connection while its client reads, so streams may only take part of the pool
+
+
+class SubscriptionsCursor(NamedTuple):
+    """Position in a listing of subscriptions, which are ordered by (start_ts, hash) descending."""
+    start_ts: int
+    subscription_hash: str
+
+    def encode(self) -> str:
+        return f'{self.start_ts}:{self.subscription_hash}'
+
+    @staticmethod
+    def decode(value: str) -> 'SubscriptionsCursor':
+        start_ts, subscription_hash = value.split(':', 1)  # ValueError for a malformed cursor
+        return SubscriptionsCursor(start_ts=int(start_ts), subscription_hash=subscription_hash)
+
+
+# The same semantics as Subscription.status, on the stored next_payment_at. Each takes the current timestamp as all of its parameters.
+SUBSCRIPTION_STATUS_SQL: dict[SubscriptionStatus, str] = {
+    'terminated': 'subscription.terminated = TRUE',
+    'expired': 'subscription.terminated = FALSE AND %(timestamp)s > subscription.next_payment_at + product.payment_period',
+    'pending': 'subscription.terminated = FALSE AND %(timestamp)s > subscription.next_payment_at AND %(timestamp)s <= subscription.next_payment_at + product.payment_period',
+    'paid': 'subscription.terminated = FALSE AND %(timestamp)s <= subscription.next_payment_at',
+}
+
+
+class SubscriptionFilter(NamedTuple):
+    merchant_domain: str | None = None
+    user_address: ChecksumAddress | None = None
+    status: SubscriptionStatus | None = None
+    product_hash: str | None = None
+    chain: Chain | None = None
+    start_ts_from: int | None = None  # inclusive
+    start_ts_to: int | None = None  # exclusive
+    terminated: bool | None = None
+
+    def to_sql(self, timestamp: int) -> tuple[list[str], dict[str, Any]]:
+        conditions: list[str] = []
+        if self.merchant_domain is not None:
+            conditions.append('product.merchant_domain = %(merchant_domain)s')
+
+        if self.user_address is not None:
+            conditions.append('subscription.user_address = %(user_address)s')
+
+        if self.status is not None:
+            conditions.append(f'({SUBSCRIPTION_STATUS_SQL[self.status]})')
+
+        if self.product_hash is not None:
+            conditions.append('subscription.product_hash = %(product_hash)s')
+
+        if self.chain is not None:
+            conditions.append('product.chain = %(chain)s')
+
+        if self.start_ts_from is not None:
+            conditions.append('subscription.start_ts >= %(start_ts_from)s')
+
+        if self.start_ts_to is not None:
+            conditions.append('subscription.start_ts < %(start_ts_to)s')
+
+        if self.terminated is not None:
+            conditions.append('subscription.terminated = %(terminated)s')
+
+        params = {**self._asdict(), 'chain': str(self.chain) if self.chain is not None else None, 'timestamp': timestamp}
+        return conditions, params
+
+
+def subscriptions_listing_sql(
+        subscription_filter: SubscriptionFilter,
+        after: SubscriptionsCursor | None,
+        limit: int | None,
+        timestamp: int,
+) -> tuple[str, dict[str, Any]]:
+    conditions, params = subscription_filter.to_sql(timestamp)
+    if after is not None:
+        conditions.append('(subscription.start_ts, subscription.hash) < (%(after_start_ts)s, %(after_hash)s)')
+        params.update(after_start_ts=after.start_ts, after_hash=after.subscription_hash)
+
+    query = SELECT_SUBSCRIPTIONS_SQL
+    if len(conditions) > 0:
+        query += f' WHERE {" AND ".join(conditions)}'
+
+    query += ' ORDER BY subscription.start_ts DESC, subscription.hash DESC'
+    if limit is not None:
+        query += ' LIMIT %(limit)s'
+        params['limit'] = limit
+
+    return query, params
+
+
+SET_SETTING_SQL = 'INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value'
+UPDATE_PAYMENTS_MADE_SQL = '''UPDATE subscription SET
+    payments_made = %(payments_made)s,
+    next_payment_at = subscription.start_ts + product.period * %(payments_made)s,
+    next_retry_at = 0,
+    lapsed = FALSE
+FROM product WHERE product.hash = subscription.product_hash AND subscription.hash = %(hash)s AND subscription.payments_made < %(payments_made)s
+RETURNING product.merchant_domain, subscription.user_id, subscription.next_payment_at + product.payment_period, subscription.next_payment_at
+'''
+RESTORE_PAYMENTS_MADE_SQL = '''UPDATE subscription SET
+    payments_made = %(payments_made)s,
+    next_payment_at = subscription.start_ts + product.period * %(payments_made)s,
+    next_retry_at = 0,
+    lapsed = FALSE
+FROM product WHERE product.hash = subscription.product_hash AND subscription.hash = %(hash)s
+'''
+RETRY_PAYMENT_SQL = 'UPDATE subscription SET next_retry_at = GREATEST(next_retry_at, %(next_retry_at)s) WHERE hash = %(hash)s AND payments_made + 1 = %(payment_number)s'
+PAYMENT_RETRY_INTERVAL = 60 * 60 * 24  # seconds until a payment is attempted again after a payment issue
+ENTITLEMENTS_SQL = '''SELECT DISTINCT ON (product.merchant_domain, subscription.user_id)
+    product.merchant_domain, subscription.user_id, subscription.next_payment_at + product.payment_period, subscription.next_payment_at
+    FROM subscription INNER JOIN product ON subscription.product_hash = product.hash
+    WHERE subscription.user_id IS NOT NULL
+    ORDER BY product.merchant_domain, subscription.user_id, subscription.next_payment_at + product.payment_period DESC
+'''
+RETRY_WATCHLIST_SQL = '''SELECT DISTINCT product.token_address, subscription.user_address
+    FROM subscription INNER JOIN product ON subscription.product_hash = product.hash WHERE
+    terminated = FALSE AND lapsed = FALSE AND next_retry_at > %s AND product.chain = %s
+'''
+REQUEUE_PAYMENTS_SQL = '''UPDATE subscription SET next_retry_at = 0 FROM product WHERE
+    product.hash = subscription.product_hash AND
+    subscription.user_address = %s AND product.token_address = %s AND product.chain = %s AND
+    next_retry_at > 0
+'''
+TERMINATE_SUBSCRIPTION_SQL = 'UPDATE subscription SET terminated = TRUE WHERE hash = %s'
+SET_MERCHANT_INITIATOR_SQL = 'INSERT INTO merchant(address, chain, initiator) VALUES(%s, %s, %s) ON CONFLICT(address, chain) DO UPDATE SET initiator=EXCLUDED.initiator'
+
+
+def insert_sql(table: str, columns: list[str], on_conflict: str = '') -> str:
+    return f'INSERT INTO {table}({",".join(columns)}) VALUES ({",".join(["%s"] * len(columns))}) {on_conflict}'
+
+
+class BlockCheckpoint(NamedTuple):
+    from_block: int
+    to_block: int
+    block_hash: str  # of to_block
+
+
+class WriteBatch:
+    """Mutations collected while applying the logs of a single block window on a single chain."""
+
+    def __init__(self, chain: Chain, last_checked_block: int, checkpoint: BlockCheckpoint | None = None):
+        self.chain = chain
+        self.last_checked_block = last_checked_block
+        # Set for windows with blocks that are not final yet. Such batches can be undone with Database.rollback().
+        self.checkpoint = checkpoint
+        self.products: dict[str, Product] = {}
+        self.subscriptions: dict[str, Subscription] = {}
+        self.merchant_initiators: dict[ChecksumAddress, ChecksumAddress] = {}
+        self.payments_made: dict[str, int] = {}
+        self.terminations: list[str] = []
+        self.funded_users: set[tuple[ChecksumAddress, ChecksumAddress]] = set()  # (token address, user address)
+
+    def add_product(self, product: Product) -> None:
+        self.products[product.product_hash] = product
+
+    def add_subscription(self, subscription: Subscription) -> None:
+        self.subscriptions.setdefault(subscription.subscription_hash, subscription)
+
+    def set_merchant_initiator(self, merchant_address: ChecksumAddress, initiator: ChecksumAddress) -> None:
+        self.merchant_initiators[merchant_address] = initiator  # The latest change wins
+
+    def update_payments_made(self, subscription_hash: str, new_payments_made: int) -> None:
+        self.payments_made[subscription_hash] = max(self.payments_made.get(subscription_hash, 0), new_payments_made)
+
+    def terminate_subscription(self, subscription_hash: str) -> None:
+        self.terminations.append(subscription_hash)
+
+    def requeue_payments(self, token_address: ChecksumAddress, user_address: ChecksumAddress) -> None:
+        self.funded_users.add((token_address, user_address))
 
 
 class Database:
-    def __init__(self, name: str, user: str, host: str, password: str, port: int):
-        self._conn = psycopg2.connect(
-            database=name, 
-            user=user, 
-            host=host,
-            password=password,
-            port=port,
+    def __init__(self, name: str, user: str, host: str, password: str, port: int, min_connections: int = 2, max_connections: int = 10):
+        # Opened in open(), since the pool's workers need a running event loop
+        self._pool = AsyncConnectionPool(
+            conninfo=make_conninfo(
+                dbname=name,
+                user=user,
+                host=host,
+                password=password,
+                port=port,
+            ),
+            min_size=min_connections,
+            max_size=max_connections,
+            open=False,
         )
-        self._db_lock = Lock()
-
-        with self.context() as cursor:
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public' AND table_type='BASE TABLE';")
-            tables = cursor.fetchall()
-            print('tables', tables)
-            if len(tables) == 0:
-                cursor.execute(DB_SCHEMA)
-
-    @contextmanager
-    def context(self):
-        with self._db_lock:
-            try:
-                yield self._conn.cursor()
-            except Exception:
-                self._conn.rollback()
-                raise
-            else:
-                self._conn.commit()
+        # Products and tokens never change once created on-chain, so they can be cached forever.
+        # Merchant initiators can change and are dropped from the cache whenever they are set.
+        self._products: LRUCache[str, Product] = LRUCache(PRODUCT_CACHE_SIZE)
+        self._tokens: LRUCache[tuple[Chain, ChecksumAddress], Token] = LRUCache(TOKEN_CACHE_SIZE)
+        self._merchant_initiators: LRUCache[tuple[Chain, ChecksumAddress], ChecksumAddress] = LRUCache(MERCHANT_CACHE_SIZE)
+        self._streams = asyncio.Semaphore(min(MAX_CONCURRENT_STREAMS, max_connections // 2))
+        # Complete, unlike the caches. Rebuilt on open and updated after every write of subscriptions or payments.
+        self.entitlements = EntitlementIndex()
+
+    async def open(self) -> None:
+        await self._pool.open(wait=True)
+
+        await self.migrate()
+        await self.warm_caches()
+        await self.load_entitlements()
+
+    async def migrate(self) -> None:
+        # All pending migrations are applied in a single transaction, so a failing one leaves the schema untouched
+        async with self.context() as cursor:
+            await cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK_ID,))
+            await cursor.execute('CREATE TABLE IF NOT EXISTS schema_migration(version BIGINT NOT NULL PRIMARY KEY, name TEXT NOT NULL, applied_at BIGINT NOT NULL)')
+            await cursor.execute('SELECT version FROM schema_migration')
+            applied_versions = {row[0] for row in await cursor.fetchall()}
+
+            if len(applied_versions) == 0:
+                # Databases created before migrations were introduced already have the initial schema
+                await cursor.execute("SELECT 1 FROM information_schema.tables WHERE table_schema='public' AND table_name='setting'")
+                if await cursor.fetchone() is not None:
+                    initial_migration = MIGRATIONS[0]
+                    await cursor.execute('INSERT INTO schema_migration(version, name, applied_at) VALUES(%s, %s, %s)', (initial_migration.version, initial_migration.name, ts_now()))
+                    applied_versions.add(initial_migration.version)
+
+            for migration in MIGRATIONS:
+                if migration.version in applied_versions:
+                    continue
+
+                logging.info(f'Applying database migration {migration.name}')
+                await cursor.execute(migration.sql)
+                await cursor.execute('INSERT INTO schema_migration(version, name, applied_at) VALUES(%s, %s, %s)', (migration.version, migration.name, ts_now()))
+
+    async def explain(self, query: str, params: Sequence[Any] | dict[str, Any] = ()) -> dict[str, Any]:
+        """Returns the json query plan. Parameters are bound on the client, since EXPLAIN can't be prepared with them."""
+        async with self._pool.connection() as conn:
+            cursor = AsyncClientCursor(conn)
+            # Discourage sequential scans, so that they only show up where there is no index to use
+            await cursor.execute('SET LOCAL enable_seqscan = off')
+            await cursor.execute(f'EXPLAIN (FORMAT JSON) {query}', params)
+            result = await cursor.fetchone()
+            await cursor.close()
+
+        return result[0][0]
+
+    async def warm_caches(self) -> None:
+        async with self.context() as cursor:
+            await cursor.execute(f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM product LIMIT %s', (PRODUCT_CACHE_SIZE,))
+            for row in await cursor.fetchall():
+                product = Product.from_db(row)
+                self._products.put(product.product_hash, product)
+
+            await cursor.execute('SELECT chain, address, initiator FROM merchant LIMIT %s', (MERCHANT_CACHE_SIZE,))
+            for chain, merchant_address, initiator in await cursor.fetchall():
+                self._merchant_initiators.put((Chain.load(chain), merchant_address), initiator)
+
+    async def load_entitlements(self) -> None:
+        async with self.context() as cursor:
+            await cursor.execute(ENTITLEMENTS_SQL)
+            rows = await cursor.fetchall()
+
+        self.entitlements.clear()
+        for merchant_domain, user_id, active_until, next_payment_at in rows:
+            self.entitlements.update(merchant_domain=merchant_domain, user_id=user_id, active_until=active_until, next_payment_at=next_payment_at)
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    @asynccontextmanager
+    async def context(self):
+        # Every context runs in its own transaction on a pooled connection.
+        # The pool commits it when the block exits normally and rolls it back on an exception.
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                yield cursor
     
-    def drop_all_tables(self):
-        with self.context() as cursor:
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public' AND table_type='BASE TABLE';")
-            tables = cursor.fetchall()
+    async def drop_all_tables(self):
+        async with self.context() as cursor:
+            await cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public' AND table_type='BASE TABLE';")
+            tables = await cursor.fetchall()
             for table_name in tables:
-                cursor.execute(f'DROP TABLE {table_name[0]} CASCADE')
+                await cursor.execute(f'DROP TABLE {table_name[0]} CASCADE')
 
-    def get_last_checked_subscriptions_block(self, chain: Chain, min_block: int) -> int:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_subscriptions_block'
-            cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
-            result = cursor.fetchone()
-            if result is None:
-                return min_block
-            else:
-                return max(min_block, int(result[0]))
-    
-    def set_last_checked_subscriptions_block(self, chain: Chain, block: int) -> None:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_subscriptions_block'
-            cursor.execute('INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value', (name, block))
-
-    def get_last_checked_payments_block(self, chain: Chain, min_block: int) -> int:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_payments_block'
-            cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
-            result = cursor.fetchone()
-            if result is None:
-                return min_block
-            else:
-                return max(min_block, int(result[0]))
-    
-    def set_last_checked_payments_block(self, chain: Chain, block: int) -> None:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_payments_block'
-            cursor.execute('INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value', (name, block))
-
-    def get_last_checked_terminations_block(self, chain: Chain, min_block: int) -> int:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_terminations_block'
-            cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
-            result = cursor.fetchone()
-            if result is None:
-                return min_block
-            else:
-                return max(min_block, int(result[0]))
-    
-    def set_last_checked_terminations_block(self, chain: Chain, block: int) -> None:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_terminations_block'
-            cursor.execute('INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value', (name, block))
-    
-    def get_last_checked_initiators_block(self, chain: Chain, min_block: int) -> int:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_initiators_block'
-            cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
-            result = cursor.fetchone()
+        self._products.clear()
+        self._tokens.clear()
+        self._merchant_initiators.clear()
+        self.entitlements.clear()
+
+    async def get_last_checked_block(self, chain: Chain, min_block: int) -> int:
+        async with self.context() as cursor:
+            name = f'{str(chain)}_last_checked_block'
+            await cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
+            result = await cursor.fetchone()
             if result is None:
+                # Resume from the per-event cursors used before all router events were scanned in a single pass.
+                # Re-applying logs is idempotent, so it's safe to start from the one that lags the most.
+                legacy_names = [f'{str(chain)}_last_checked_{events}_block' for events in ('subscriptions', 'payments', 'terminations', 'initiators')]
+                await cursor.execute('SELECT MIN(value::BIGINT) FROM setting WHERE name = ANY(%s)', (legacy_names,))
+                result = await cursor.fetchone()
+
+            if result is None or result[0] is None:
                 return min_block
             else:
                 return max(min_block, int(result[0]))
 
-    def set_last_checked_initiators_block(self, chain: Chain, block: int) -> None:
-        with self.context() as cursor:
-            name = f'{str(chain)}_last_checked_initiators_block'
-            cursor.execute('INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value', (name, block))
+    async def set_last_checked_block(self, chain: Chain, block: int) -> None:
+        async with self.context() as cursor:
+            name = f'{str(chain)}_last_checked_block'
+            await cursor.execute(SET_SETTING_SQL, (name, str(block)))
 
-    def get_initiator_available(self, chain: Chain) -> bool:
-        with self.context() as cursor:
+    async def get_initiator_available(self, chain: Chain) -> bool:
+        async with self.context() as cursor:
             name = f'{str(chain)}_initiator_available'
-            cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
-            return cursor.fetchone() is None  # If there is no setting set -- the initiator is NOT stuck and good to go!
+            await cursor.execute('SELECT value FROM setting WHERE name = %s', (name,))
+            return await cursor.fetchone() is None  # If there is no setting set -- the initiator is NOT stuck and good to go!
 
-    def disable_initiator(self, chain: Chain) -> None:
-        with self.context() as cursor:
+    async def disable_initiator(self, chain: Chain) -> None:
+        async with self.context() as cursor:
             name = f'{str(chain)}_initiator_available'
-            cursor.execute('INSERT INTO setting (name, value) VALUES (%s, %s) ON CONFLICT(name) DO UPDATE SET name=EXCLUDED.name, value=EXCLUDED.value', (name, 'stuck!!!!!'))
+            await cursor.execute(SET_SETTING_SQL, (name, 'stuck!!!!!'))
 
-    def add_product(self, product: Product) -> None:
-        with self.context() as cursor:
-            product_db_dict = product.to_db()
-            columns = list(product_db_dict.keys())
-            values = list(product_db_dict.values())
-            cursor.execute(
-                f'INSERT INTO product({",".join(columns)}) VALUES ({",".join(["%s"] * len(values))}) ON CONFLICT (hash) DO NOTHING',
-                values,
-            )
-    
-    def get_product_by_hash(self, product_hash: str) -> Product | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM product WHERE hash = %s', (product_hash,))
-            result = cursor.fetchone()
+    async def get_product_by_hash(self, product_hash: str) -> Product | None:
+        product = self._products.get(product_hash)
+        if product is not None:
+            return product
+
+        async with self.context() as cursor:
+            await cursor.execute(f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM product WHERE hash = %s', (product_hash,))
+            result = await cursor.fetchone()
             if result is None:
                 return None
             
-            return Product.from_db(result)
+            product = Product.from_db(result)
+            self._products.put(product_hash, product)
+            return product
     
-    def add_subscription(self, subscription: Subscription) -> None:
-        with self.context() as cursor:
-            subscription_db_dict = subscription.to_db()
-            columns = list(subscription_db_dict.keys())
-            values = list(subscription_db_dict.values())
-            cursor.execute(
-                f'INSERT INTO subscription({",".join(columns)}) VALUES ({",".join(["%s"] * len(values))}) ON CONFLICT (hash) DO NOTHING',
-                values,
+    async def add_token(self, token: Token) -> None:
+        async with self.context() as cursor:
+            token_db_dict = token.to_db()
+            await cursor.execute(
+                insert_sql('token', list(token_db_dict.keys()), 'ON CONFLICT (chain, address) DO NOTHING'),
+                list(token_db_dict.values()),
             )
 
-    def update_payments_made(self, subscription_hash: str, new_payments_made: int):
-        with self.context() as cursor:
-            cursor.execute('UPDATE subscription SET payments_made = GREATEST(payments_made, %s) WHERE hash = %s', (new_payments_made, subscription_hash))
-    
-    def terminate_subscription(self, subscription_hash: str):
-        with self.context() as cursor:
-            cursor.execute('UPDATE subscription SET terminated = TRUE WHERE hash = %s', (subscription_hash,))
-    
-    def load_single_subscription(self, row: tuple) -> Subscription:
-        # TODO: change. All subscription-related fields should be read in a single db query and loaded all at once.
-        product = self.get_product_by_hash(row[1])
-        if product is None:
-            raise AssertionError(f'No corresponding product was found for subscription row {row}!!!!!!!')
-        
-        row_with_product = (row[0], product, *row[2:])
-        return Subscription.from_db(row_with_product)
+        self._tokens.put((token.chain, token.address), token)
 
-    def get_all_subscriptions(self) -> list[Subscription]:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription')
-            rows = cursor.fetchall()
-        
-        return [self.load_single_subscription(row) for row in rows]
+    async def get_token(self, chain: Chain, address: ChecksumAddress) -> Token | None:
+        token = self._tokens.get((chain, address))
+        if token is not None:
+            return token
 
-    def get_subscriptions_by_user(self, address: ChecksumAddress) -> list[Subscription]:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription WHERE user_address = %s', (address,))
-            rows = cursor.fetchall()
-        
-        return [self.load_single_subscription(row) for row in rows]
+        async with self.context() as cursor:
+            await cursor.execute('SELECT chain, address, symbol, decimals FROM token WHERE chain = %s AND address = %s', (str(chain), address))
+            result = await cursor.fetchone()
+            if result is None:
+                return None
+
+            token = Token.from_db(result)
+            self._tokens.put((chain, address), token)
+            return token
+
+    async def get_call_result(self, chain: Chain, contract_address: ChecksumAddress, selector: str, args: str) -> str | None:
+        async with self.context() as cursor:
+            await cursor.execute(
+                'SELECT result FROM contract_call_cache WHERE chain = %s AND contract_address = %s AND selector = %s AND args = %s',
+                (str(chain), contract_address, selector, args),
+            )
+            result = await cursor.fetchone()
+
+        return result[0] if result is not None else None
+
+    async def store_call_result(self, chain: Chain, contract_address: ChecksumAddress, selector: str, args: str, result: str) -> None:
+        async with self.context() as cursor:
+            await cursor.execute(
+                insert_sql('contract_call_cache', ['chain', 'contract_address', 'selector', 'args', 'result'], 'ON CONFLICT DO NOTHING'),
+                (str(chain), contract_address, selector, args, result),
+            )
+
+    async def update_payments_made(self, subscription_hash: str, new_payments_made: int):
+        async with self.context() as cursor:
+            await cursor.execute(UPDATE_PAYMENTS_MADE_SQL, {'payments_made': new_payments_made, 'hash': subscription_hash})
+            updated_rows = await cursor.fetchall()
+
+        for merchant_domain, user_id, active_until, next_payment_at in updated_rows:
+            self.entitlements.update(merchant_domain=merchant_domain, user_id=user_id, active_until=active_until, next_payment_at=next_payment_at)
     
-    def get_subscriptions_by_merchant(self, merchant_domain: str) -> list[Subscription]:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription INNER JOIN product ON subscription.product_hash = product.hash WHERE merchant_domain = %s', (merchant_domain,))
-            rows = cursor.fetchall()
-        
-        return [self.load_single_subscription(row) for row in rows]
+    async def apply_write_batch(self, batch: WriteBatch) -> None:
+        # Everything goes in a single transaction together with the cursor, so a crash can't leave a window half-applied.
+        # The order matters because of foreign keys and because payments and terminations may refer to subscriptions from the same batch.
+        updated_rows: list[tuple[str, str | None, int, int]] = []
+        async with self.context() as cursor:
+            if batch.checkpoint is not None:
+                undo = await self.collect_undo(cursor, batch)
+                await cursor.execute(
+                    insert_sql('block_checkpoint', ['chain', 'from_block', 'to_block', 'block_hash', 'undo']),
+                    (str(batch.chain), batch.checkpoint.from_block, batch.checkpoint.to_block, batch.checkpoint.block_hash, json.dumps(undo)),
+                )
+
+            if batch.products:
+                product_rows = [product.to_db() for product in batch.products.values()]
+                await cursor.executemany(
+                    insert_sql('product', list(product_rows[0].keys()), 'ON CONFLICT (hash) DO NOTHING'),
+                    [list(row.values()) for row in product_rows],
+                )
+
+            if batch.subscriptions:
+                subscription_rows = [subscription.to_db() for subscription in batch.subscriptions.values()]
+                await cursor.executemany(
+                    insert_sql('subscription', list(subscription_rows[0].keys()), 'ON CONFLICT (hash) DO NOTHING'),
+                    [list(row.values()) for row in subscription_rows],
+                )
+
+            if batch.merchant_initiators:
+                await cursor.executemany(
+                    SET_MERCHANT_INITIATOR_SQL,
+                    [(merchant_address, str(batch.chain), initiator) for merchant_address, initiator in batch.merchant_initiators.items()],
+                )
+
+            if batch.payments_made:
+                await cursor.executemany(
+                    UPDATE_PAYMENTS_MADE_SQL,
+                    [{'payments_made': new_payments_made, 'hash': subscription_hash} for subscription_hash, new_payments_made in batch.payments_made.items()],
+                    returning=True,
+                )
+                while True:
+                    updated_rows.extend(await cursor.fetchall())
+                    if not cursor.nextset():
+                        break
+
+            if batch.terminations:
+                await cursor.executemany(TERMINATE_SUBSCRIPTION_SQL, [(subscription_hash,) for subscription_hash in batch.terminations])
+
+            if batch.funded_users:
+                await cursor.executemany(
+                    REQUEUE_PAYMENTS_SQL,
+                    [(user_address, token_address, str(batch.chain)) for token_address, user_address in batch.funded_users],
+                )
+
+            await cursor.execute(SET_SETTING_SQL, (f'{str(batch.chain)}_last_checked_block', str(batch.last_checked_block)))
+
+        for product in batch.products.values():
+            self._products.put(product.product_hash, product)
+
+        for merchant_address in batch.merchant_initiators:
+            self._merchant_initiators.pop((batch.chain, merchant_address))
+
+        for subscription in batch.subscriptions.values():
+            self.entitlements.add_subscription(subscription)
+
+        for merchant_domain, user_id, active_until, next_payment_at in updated_rows:
+            self.entitlements.update(merchant_domain=merchant_domain, user_id=user_id, active_until=active_until, next_payment_at=next_payment_at)
     
-    def get_subscriptions_by_merchant_and_user(self, merchant_domain: str, userid: str) -> list[Subscription]:
-        with self.context() as cursor:
-            cursor.execute("SELECT * FROM subscription INNER JOIN product ON subscription.product_hash = product.hash WHERE merchant_domain = %s AND user_id = %s", (merchant_domain, userid))
-            rows = cursor.fetchall()
+    async def collect_undo(self, cursor: AsyncCursor, batch: WriteBatch) -> dict[str, Any]:
+        """Returns the state that the batch is about to change. Products, tokens and metadata are immutable and stay after a rollback."""
+        undo: dict[str, Any] = {'subscriptions': [], 'payments_made': {}, 'terminations': [], 'merchant_initiators': {}}
+        if batch.subscriptions:
+            await cursor.execute('SELECT hash FROM subscription WHERE hash = ANY(%s)', (list(batch.subscriptions),))
+            existing_hashes = {row[0] for row in await cursor.fetchall()}
+            undo['subscriptions'] = [subscription_hash for subscription_hash in batch.subscriptions if subscription_hash not in existing_hashes]
+
+        if batch.payments_made or batch.terminations:
+            await cursor.execute('SELECT hash, payments_made, terminated FROM subscription WHERE hash = ANY(%s)', (list(batch.payments_made) + batch.terminations,))
+            for subscription_hash, payments_made, terminated in await cursor.fetchall():
+                if subscription_hash in batch.payments_made:
+                    undo['payments_made'][subscription_hash] = payments_made
+
+                if subscription_hash in batch.terminations and not terminated:
+                    undo['terminations'].append(subscription_hash)
+
+        if batch.merchant_initiators:
+            await cursor.execute('SELECT address, initiator FROM merchant WHERE chain = %s AND address = ANY(%s)', (str(batch.chain), list(batch.merchant_initiators)))
+            initiators = dict(await cursor.fetchall())
+            undo['merchant_initiators'] = {merchant_address: initiators.get(merchant_address) for merchant_address in batch.merchant_initiators}
+
+        return undo
+
+    async def get_block_checkpoints(self, chain: Chain) -> list[BlockCheckpoint]:
+        """Newest first"""
+        async with self.context() as cursor:
+            await cursor.execute('SELECT from_block, to_block, block_hash FROM block_checkpoint WHERE chain = %s ORDER BY to_block DESC', (str(chain),))
+            return [BlockCheckpoint(*row) for row in await cursor.fetchall()]
+
+    async def prune_block_checkpoints(self, chain: Chain, final_block: int) -> None:
+        async with self.context() as cursor:
+            await cursor.execute('DELETE FROM block_checkpoint WHERE chain = %s AND to_block <= %s', (str(chain), final_block))
+
+    async def rollback(self, chain: Chain, block: int) -> None:
+        """Undoes all checkpointed batches after the block, newest first, and moves the cursor back to the block."""
+        merchant_addresses: set[ChecksumAddress] = set()
+        async with self.context() as cursor:
+            await cursor.execute('SELECT undo FROM block_checkpoint WHERE chain = %s AND to_block > %s ORDER BY to_block DESC', (str(chain), block))
+            for (undo,) in await cursor.fetchall():
+                for merchant_address, initiator in undo['merchant_initiators'].items():
+                    merchant_addresses.add(merchant_address)
+                    if initiator is None:
+                        await cursor.execute('DELETE FROM merchant WHERE address = %s AND chain = %s', (merchant_address, str(chain)))
+                    else:
+                        await cursor.execute(SET_MERCHANT_INITIATOR_SQL, (merchant_address, str(chain), initiator))
+
+                if undo['terminations']:
+                    await cursor.executemany('UPDATE subscription SET terminated = FALSE WHERE hash = %s', [(subscription_hash,) for subscription_hash in undo['terminations']])
+
+                if undo['payments_made']:
+                    await cursor.executemany(
+                        RESTORE_PAYMENTS_MADE_SQL,
+                        [{'payments_made': payments_made, 'hash': subscription_hash} for subscription_hash, payments_made in undo['payments_made'].items()],
+                    )
+
+                if undo['subscriptions']:
+                    await cursor.executemany('DELETE FROM subscription WHERE hash = %s', [(subscription_hash,) for subscription_hash in undo['subscriptions']])
+
+            await cursor.execute('DELETE FROM block_checkpoint WHERE chain = %s AND to_block > %s', (str(chain), block))
+            await cursor.execute(SET_SETTING_SQL, (f'{str(chain)}_last_checked_block', str(block)))
+
+        for merchant_address in merchant_addresses:
+            self._merchant_initiators.pop((chain, merchant_address))
+
+        # Entitlements only ever grow, so they are rebuilt instead of undone
+        await self.load_entitlements()
+
+    def load_subscriptions(self, rows: list[tuple]) -> list[Subscription]:
+        # Rows are selected with SELECT_SUBSCRIPTIONS_SQL, i.e. subscription columns followed by product columns.
+        # Many subscriptions usually share a product, so a single (cached) Product instance is used for all of them.
+        subscriptions = []
+        for row in rows:
+            subscription_row = row[:len(SUBSCRIPTION_COLUMNS)]
+            product_row = row[len(SUBSCRIPTION_COLUMNS):]
+
+            product = self._products.get(product_row[0])
+            if product is None:
+                product = Product.from_db(product_row)
+                self._products.put(product.product_hash, product)
+
+            subscriptions.append(Subscription.from_db((subscription_row[0], product, *subscription_row[2:])))
 
-        return [self.load_single_subscription(row) for row in rows]
+        return subscriptions
+
+    async def get_subscriptions_page(
+            self,
+            subscription_filter: SubscriptionFilter,
+            limit: int,
+            after: SubscriptionsCursor | None = None,
+    ) -> tuple[list[Subscription], SubscriptionsCursor | None]:
+        """Returns up to limit subscriptions, newest first, and the cursor of the next page if there is one."""
+        query, params = subscriptions_listing_sql(subscription_filter, after, limit + 1, ts_now())  # One more to know if there is a next page
+        async with self.context() as cursor:
+            await cursor.execute(query, params)
+            rows = await cursor.fetchall()
+
+        subscriptions = self.load_subscriptions(rows[:limit])
+        if len(rows) <= limit:
+            return subscriptions, None
+
+        return subscriptions, SubscriptionsCursor(start_ts=subscriptions[-1].start_ts, subscription_hash=subscriptions[-1].subscription_hash)
+
+    def can_stream(self) -> bool:
+        return not self._streams.locked()
+
+    async def stream_subscriptions(self, subscription_filter: SubscriptionFilter, after: SubscriptionsCursor | None = None) -> AsyncIterator[Subscription]:
+        """Yields subscriptions in the order of get_subscriptions_page, reading them in batches through a server-side cursor.
+
+        At most MAX_CONCURRENT_STREAMS run at once, so that slow clients can't take all connections from the indexers.
+        """
+        query, params = subscriptions_listing_sql(subscription_filter, after, limit=None, timestamp=ts_now())
+        async with self._streams, self._pool.connection() as conn:
+            async with conn.cursor(name='stream_subscriptions') as cursor:
+                await cursor.execute(query, params)
+                while True:
+                    rows = await cursor.fetchmany(SUBSCRIPTIONS_STREAM_BATCH_SIZE)
+                    if len(rows) == 0:
+                        break
+
+                    for subscription in self.load_subscriptions(rows):
+                        yield subscription
+
+    async def get_subscriptions_by_merchant_and_user(self, merchant_domain: str, userid: str) -> list[Subscription]:
+        async with self.context() as cursor:
+            await cursor.execute(SUBSCRIPTIONS_BY_MERCHANT_AND_USER_SQL, (merchant_domain, userid))
+            rows = await cursor.fetchall()
+
+        return self.load_subscriptions(rows)
     
-    def get_subscription_by_merchant_and_subscriptionid(self, merchant_domain: str, subscription_id: str) -> Subscription | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription WHERE merchant_domain = %s AND subscription_id=%s ORDER BY start_ts LIMIT 1', (merchant_domain, subscription_id))
-            result = cursor.fetchone()
+    async def get_subscription_by_merchant_and_subscriptionid(self, merchant_domain: str, subscription_id: str) -> Subscription | None:
+        async with self.context() as cursor:
+            await cursor.execute(SUBSCRIPTION_BY_MERCHANT_AND_SUBSCRIPTIONID_SQL, (merchant_domain, subscription_id))
+            result = await cursor.fetchone()
 
         if result is None:
             return None
             
-        return self.load_single_subscription(result)
+        return self.load_subscriptions([result])[0]
     
-    def get_subscription_by_hash(self, subscription_hash: str) -> Subscription | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription WHERE hash = %s', (subscription_hash,))
-            result = cursor.fetchone()
+    async def get_subscription_by_hash(self, subscription_hash: str) -> Subscription | None:
+        async with self.context() as cursor:
+            await cursor.execute(SUBSCRIPTION_BY_HASH_SQL, (subscription_hash,))
+            result = await cursor.fetchone()
 
         if result is None:
             return None
 
-        return self.load_single_subscription(result)
-
-    def get_payable_subscriptions(self, chain: Chain, timestamp: int, initiator: ChecksumAddress) -> list[Subscription]:
-        with self.context() as cursor:
-            cursor.execute(
-                '''SELECT * FROM subscription INNER JOIN product ON subscription.product_hash = product.hash INNER JOIN merchant ON product.merchant_address = merchant.address AND product.chain = merchant.chain WHERE
-                product.chain = %s AND terminated = FALSE AND
-                %s >= start_ts + period * payments_made AND
-                %s < start_ts + period * payments_made + payment_period AND
-                initiator = %s AND
-                %s >= (SELECT GREATEST(MAX(timestamp), 0) FROM subscription_log WHERE
-                    subscription_hash = subscription.hash AND
-                    log_type = 'payment-issue' AND
-                    payment_number = subscription.payments_made + 1
-                ) + %s
-                ''',
-                (
-                    str(chain),
-                    timestamp,
-                    timestamp,
-                    initiator,
-                    timestamp,
-                    60 * 60 * 24, # Attempt payments every 24 hours in case of issues 
-                ),
-            )
-            rows = cursor.fetchall()
+        return self.load_subscriptions([result])[0]
+
+    async def get_payable_subscriptions(self, chain: Chain, timestamp: int, initiator: ChecksumAddress, limit: int) -> list[Subscription]:
+        """Returns at most limit subscriptions that are due for a payment, the longest overdue first."""
+        params = {'chain': str(chain), 'timestamp': timestamp, 'initiator': initiator, 'limit': limit}
+        async with self.context() as cursor:
+            await cursor.execute(LAPSE_SUBSCRIPTIONS_SQL, params)
+            await cursor.execute(PAYABLE_SUBSCRIPTIONS_SQL, params)
+            rows = await cursor.fetchall()
         
-        return [self.load_single_subscription(row) for row in rows]
-
-    def add_subscription_log(self, log: SubscriptionLog):
-        with self.context() as cursor:
-            log_db_dict = log.to_db()
-            columns = list(log_db_dict.keys())
-            values = list(log_db_dict.values())
-            cursor.execute(
-                f'INSERT INTO subscription_log({",".join(columns)}) VALUES ({",".join(["%s"] * len(values))})',
-                values,
+        return self.load_subscriptions(rows)
+
+    async def get_retry_watchlist(self, chain: Chain, timestamp: int) -> set[tuple[ChecksumAddress, ChecksumAddress]]:
+        """Returns (token address, user address) pairs of subscriptions whose payments wait for a retry after a payment issue."""
+        async with self.context() as cursor:
+            await cursor.execute(RETRY_WATCHLIST_SQL, (timestamp, str(chain)))
+            return {(token_address, user_address) for token_address, user_address in await cursor.fetchall()}
+
+    async def add_subscription_log(self, log: SubscriptionLog):
+        await self.add_subscription_logs([log])
+
+    async def add_subscription_logs(self, logs: list[SubscriptionLog]):
+        if len(logs) == 0:
+            return
+
+        async with self.context() as cursor:
+            log_rows = [log.to_db() for log in logs]
+            await cursor.executemany(
+                insert_sql('subscription_log', list(log_rows[0].keys())),
+                [list(row.values()) for row in log_rows],
             )
 
-    def get_subscription_logs(self, subscription_hash: str) -> list[SubscriptionLog]:
-        with self.context() as cursor:
-            cursor.execute('SELECT * FROM subscription_log WHERE subscription_hash=%s', (subscription_hash,))
-            return [SubscriptionLog.from_db(row) for row in cursor.fetchall()]
+            issue_logs = [log for log in logs if log.log_type == 'payment-issue']
+            if len(issue_logs) > 0:
+                await cursor.executemany(
+                    RETRY_PAYMENT_SQL,
+                    [
+                        {'hash': log.subscription_hash, 'payment_number': log.payment_number, 'next_retry_at': log.timestamp + PAYMENT_RETRY_INTERVAL}
+                        for log in issue_logs
+                    ],
+                )
+
+    async def get_subscription_logs(self, subscription_hash: str) -> list[SubscriptionLog]:
+        async with self.context() as cursor:
+            await cursor.execute('SELECT * FROM subscription_log WHERE subscription_hash=%s', (subscription_hash,))
+            return [SubscriptionLog.from_db(row) for row in await cursor.fetchall()]
 
-    def store_metadata(self, ipfs_cid: str, content: str):
-        with self.context() as cursor:
-            cursor.execute('INSERT INTO metadata(ipfs_cid, content) VALUES(%s, %s) ON CONFLICT (ipfs_cid) DO NOTHING', (ipfs_cid, content))
+    async def store_metadata(self, ipfs_cid: str, content: str):
+        async with self.context() as cursor:
+            await cursor.execute('INSERT INTO metadata(ipfs_cid, content) VALUES(%s, %s) ON CONFLICT (ipfs_cid) DO NOTHING', (ipfs_cid, content))
 
-    def get_metadata_by_ipfs_cid(self, ipfs_cid_hex: str) -> str | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT content FROM metadata WHERE ipfs_cid = %s', (ipfs_cid_hex,))
-            result = cursor.fetchone()
+    async def get_metadata_by_ipfs_cid(self, ipfs_cid_hex: str) -> str | None:
+        async with self.context() as cursor:
+            await cursor.execute('SELECT content FROM metadata WHERE ipfs_cid = %s', (ipfs_cid_hex,))
+            result = await cursor.fetchone()
             if result is None:
                 return None
 
             return result[0]
     
-    def get_metadata_ipfs_cid_by_content(self, content: str) -> str | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT ipfs_cid FROM metadata WHERE content = %s', (content,))
-            result = cursor.fetchone()
+    async def get_metadata_ipfs_cid_by_content(self, content: str) -> str | None:
+        async with self.context() as cursor:
+            await cursor.execute('SELECT ipfs_cid FROM metadata WHERE content = %s', (content,))
+            result = await cursor.fetchone()
             if result is None:
                 return None
             
             return result[0]
 
-    def get_merchant_initiator(self, merchant_address: ChecksumAddress, chain: Chain) -> ChecksumAddress | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT initiator FROM merchant WHERE chain = %s AND address = %s', (str(chain), merchant_address))
-            result = cursor.fetchone()
+    async def get_merchant_initiator(self, merchant_address: ChecksumAddress, chain: Chain) -> ChecksumAddress | None:
+        initiator = self._merchant_initiators.get((chain, merchant_address))
+        if initiator is not None:
+            return initiator
+
+        async with self.context() as cursor:
+            await cursor.execute('SELECT initiator FROM merchant WHERE chain = %s AND address = %s', (str(chain), merchant_address))
+            result = await cursor.fetchone()
             if result is None:
                 return None
             
+            self._merchant_initiators.put((chain, merchant_address), result[0])
             return result[0]
 
-    def set_merchant_initiator(self, merchant_address: ChecksumAddress, chain: Chain, initiator: ChecksumAddress) -> None:
-        with self.context() as cursor:
-            cursor.execute('INSERT INTO merchant(address, chain, initiator) VALUES(%s, %s, %s) ON CONFLICT(address, chain) DO UPDATE SET initiator=EXCLUDED.initiator', (merchant_address, str(chain), initiator))
-
-    def get_shortcut(self, shortcut_id: str) -> dict[str, Any] | None:
-        with self.context() as cursor:
-            cursor.execute('SELECT content FROM shortcut WHERE id = %s', (shortcut_id,))
-            result = cursor.fetchone()
+    async def get_shortcut(self, shortcut_id: str) -> dict[str, Any] | None:
+        async with self.context() as cursor:
+            await cursor.execute('SELECT content FROM shortcut WHERE id = %s', (shortcut_id,))
+            result = await cursor.fetchone()
             if result is None:
                 return None
             
@@ -303,9 +789,9 @@ class Database:
             
             return shortcut_content
 
-    def save_shortcut(self, shortcut_id: str, shortcut_content: dict[str, Any]) -> None:
-        with self.context() as cursor:
-            cursor.execute(
+    async def save_shortcut(self, shortcut_id: str, shortcut_content: dict[str, Any]) -> None:
+        async with self.context() as cursor:
+            await cursor.execute(
                 'INSERT INTO shortcut(id, content) VALUES(%s, %s)',
                 (shortcut_id, json.dumps(shortcut_content)),
             )
\ No newline at end of file
@@ -0,0 +1,51 @@
+from typing import NamedTuple
+from common_types import Subscription
+
+
+class Entitlement(NamedTuple):
+    active_until: int
+    next_payment_at: int  # Of the subscription that is active the longest
+
+    def is_active(self, timestamp: int) -> bool:
+        return timestamp <= self.active_until
+
+
+class EntitlementIndex:
+    """The latest "active until" timestamp of every (merchant domain, user id), so that entitlement checks don't touch the database.
+
+    A subscription is active until the end of the payment period of its next payment, even if it was terminated.
+    Payments only move that moment forward, so the index only ever keeps the maximum.
+    """
+
+    def __init__(self) -> None:
+        self._entitlements: dict[tuple[str, str], Entitlement] = {}
+
+    def __len__(self) -> int:
+        return len(self._entitlements)
+
+    def clear(self) -> None:
+        self._entitlements.clear()
+
+    def update(self, merchant_domain: str, user_id: str | None, active_until: int, next_payment_at: int) -> None:
+        if user_id is None:
+            return  # Subscriptions without a user id can't be looked up
+
+        key = (merchant_domain, user_id)
+        entitlement = self._entitlements.get(key)
+        if entitlement is None or active_until > entitlement.active_until:
+            self._entitlements[key] = Entitlement(active_until=active_until, next_payment_at=next_payment_at)
+
+    def add_subscription(self, subscription: Subscription) -> None:
+        self.update(
+            merchant_domain=subscription.product.merchant_domain,
+            user_id=subscription.user_id,
+            active_until=subscription.next_payment_at + subscription.product.payment_period,
+            next_payment_at=subscription.next_payment_at,
+        )
+
+    def get(self, merchant_domain: str, user_id: str) -> Entitlement | None:
+        return self._entitlements.get((merchant_domain, user_id))
+
+    def is_active(self, merchant_domain: str, user_id: str, timestamp: int) -> bool:
+        entitlement = self._entitlements.get((merchant_domain, user_id))
+        return entitlement is not None and entitlement.is_active(timestamp)
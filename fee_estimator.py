@@ -0,0 +1,48 @@
+import asyncio
+from typing import NamedTuple
+from eth_typing import BlockNumber
+from web3 import AsyncWeb3
+from web3.types import Wei
+
+FEE_HISTORY_BLOCKS = 5
+PRIORITY_FEE_PERCENTILE = 60
+
+
+class FeeSnapshot(NamedTuple):
+    block_number: int
+    next_base_fee: Wei  # Base fee of the block after block_number
+    priority_fee: Wei
+
+
+class FeeEstimator:
+    """Fee estimates of a single chain, fetched once per block and shared by all payments made within it."""
+
+    def __init__(self, web3: AsyncWeb3) -> None:
+        self.web3 = web3
+        self._snapshot: FeeSnapshot | None = None
+        self._lock = asyncio.Lock()
+
+    async def get_snapshot(self, block_number: int) -> FeeSnapshot:
+        async with self._lock:
+            if self._snapshot is None or self._snapshot.block_number < block_number:
+                self._snapshot = await self._fetch_snapshot(block_number)
+
+            return self._snapshot
+
+    async def _fetch_snapshot(self, block_number: int) -> FeeSnapshot:
+        fee_history = await self.web3.eth.fee_history(FEE_HISTORY_BLOCKS, BlockNumber(block_number), [PRIORITY_FEE_PERCENTILE])
+        if len(fee_history['baseFeePerGas']) == 0:
+            raise AssertionError(f'No base fees in fee history {fee_history} at block {block_number}!!!!!!!!!!!!!')
+
+        # Empty blocks report a zero reward, which says nothing about the priority fee needed for inclusion
+        rewards = sorted(reward[0] for reward in fee_history['reward'] if len(reward) > 0 and reward[0] > 0)
+        if len(rewards) > 0:
+            priority_fee = rewards[len(rewards) // 2]
+        else:
+            priority_fee = await self.web3.eth.max_priority_fee
+
+        return FeeSnapshot(
+            block_number=block_number,
+            next_base_fee=fee_history['baseFeePerGas'][-1],
+            priority_fee=Wei(priority_fee),
+        )
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import time
+import websockets
+from web3 import AsyncWeb3
+
+MIN_POLL_INTERVAL = 1  # seconds
+WS_RECONNECT_DELAY = 1  # seconds, doubled after every failed connection
+WS_MAX_RECONNECT_DELAY = 60
+HEAD_SILENCE_TIMEOUT = 60  # seconds without a new head after which the node is polled anyway
+
+
+class HeadWatcher:
+    """Tells a chain's indexer when a new block arrives.
+
+    New heads are pushed through an eth_subscribe('newHeads') WebSocket subscription if the chain has a WebSocket RPC.
+    Without one, or while the socket is down, the node is polled at the observed block time instead.
+    """
+
+    def __init__(self, web3: AsyncWeb3, ws_rpc: str | None, poll_interval: float) -> None:
+        self.web3 = web3
+        self.ws_rpc = ws_rpc
+        self.max_poll_interval = poll_interval
+        self.poll_interval = poll_interval  # Adapts to the observed block time
+        self.latest_block: int | None = None
+        self.connected = False
+        self._new_head = asyncio.Event()
+        self._latest_block_at = time.monotonic()
+
+    async def run(self) -> None:
+        """Keeps the newHeads subscription alive. Returns right away if the chain has no WebSocket RPC."""
+        if self.ws_rpc is None:
+            return
+
+        reconnect_delay = WS_RECONNECT_DELAY
+        while True:
+            try:
+                async with websockets.connect(self.ws_rpc) as websocket:
+                    await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}))
+                    response = json.loads(await websocket.recv())
+                    if 'error' in response:
+                        raise ConnectionError(f'Could not subscribe to new heads: {response["error"]}')
+
+                    self.connected = True
+                    reconnect_delay = WS_RECONNECT_DELAY
+                    logging.info(f'Subscribed to new heads at {self.ws_rpc}')
+                    async for message in websocket:
+                        notification = json.loads(message)
+                        if notification.get('method') == 'eth_subscription':
+                            self.on_block(int(notification['params']['result']['number'], 16))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'New heads subscription at {self.ws_rpc} failed: {e!r}. Falling back to polling, reconnecting in {reconnect_delay} seconds.')
+            finally:
+                self.connected = False
+                self._new_head.set()  # Wakes up waiters, so that they switch to polling
+
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, WS_MAX_RECONNECT_DELAY)
+
+    def on_block(self, block_number: int) -> None:
+        if self.latest_block is not None and block_number <= self.latest_block:
+            return  # Duplicate or a reorg to a shorter chain, which the next new block reveals anyway
+
+        now = time.monotonic()
+        if self.latest_block is not None:
+            block_time = (now - self._latest_block_at) / (block_number - self.latest_block)
+            # Smoothed, so that a single slow or fast block doesn't swing the polling rate
+            self.poll_interval = min(max(0.8 * self.poll_interval + 0.2 * block_time, MIN_POLL_INTERVAL), self.max_poll_interval)
+
+        self.latest_block = block_number
+        self._latest_block_at = now
+        self._new_head.set()
+
+    async def wait_for_new_block(self, after_block: int | None) -> int:
+        """Returns the latest block number as soon as it is higher than after_block."""
+        while self.latest_block is None or (after_block is not None and self.latest_block <= after_block):
+            if self.latest_block is not None:
+                self._new_head.clear()
+                # While connected the socket pushes new heads. Otherwise it may reconnect while we wait for the next poll.
+                timeout = HEAD_SILENCE_TIMEOUT if self.connected else self.poll_interval
+                try:
+                    await asyncio.wait_for(self._new_head.wait(), timeout=timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    if self.connected:
+                        logging.warning(f'No new heads from {self.ws_rpc} for {HEAD_SILENCE_TIMEOUT} seconds. Polling the node.')
+
+            self.on_block(await self.web3.eth.block_number)
+
+        return self.latest_block
@@ -8,18 +8,22 @@ import base58
 from dotenv import load_dotenv
 import asyncio
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import requests
-from api_models import SerializedSubscription
+from api_models import EntitlementsRequest, SerializedEntitlement, SerializedSubscription
 
 from chain_indexer import ChainIndexer
-from common_types import Chain
+from common_types import Chain, ChainConfig, SubscriptionStatus
 from constants import ALL_CHAINS_CONFIGS, PINATA_API_KEY
 from eth_utils.address import to_checksum_address
 
-from database import Database
-from utils import sort_subscriptions
+from database import Database, SubscriptionFilter, SubscriptionsCursor
+from head_watcher import HeadWatcher
+from metadata_resolver import MetadataResolver
+from price_oracle import TOKEN_TO_BINANCE_SYMBOL, BinancePriceSource, PriceOracle
+from utils import sort_subscriptions, ts_now
 
 
 db = Database(
@@ -29,6 +33,9 @@ db = Database(
     password=os.environ['DB_PASSWORD'],
     port=int(os.environ['DB_PORT']),
 )
+metadata_resolver = MetadataResolver(db)
+price_source = BinancePriceSource()
+price_oracle = PriceOracle(price_source)
 
 app_description = '''
 For `merchant_domain` use your domain. For example `paybeaver.xyz`.
@@ -54,8 +61,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Browsers hide other response headers from scripts
 )
 
+MAX_INDEXER_BACKOFF = 5 * 60
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+chain_configs: dict[Chain, ChainConfig] = {config.chain: config for config in ALL_CHAINS_CONFIGS}
 indexers: dict[Chain, ChainIndexer] = {}
 for config in ALL_CHAINS_CONFIGS:
     indexers[config.chain] = ChainIndexer(
@@ -63,50 +76,164 @@ for config in ALL_CHAINS_CONFIGS:
         router_address=config.router_address,
         rpc=config.rpc,
         db=db,
+        metadata_resolver=metadata_resolver,
+        price_oracle=price_oracle,
         min_block=config.min_block,
         initiator_private_key=os.environ['INITIATOR_PRIVATE_KEY'],
         needs_poa_middleware=config.needs_poa_middleware,
+        confirmations=config.confirmations,
     )
 
-async def check_subscriptions():
-    for indexer in indexers.values():
-        await indexer.discover_new_subscriptions()
-        await indexer.discover_new_payments()
-        await indexer.discover_new_terminations()
-        await indexer.pay_payable_subscriptions()
+head_watchers: dict[Chain, HeadWatcher] = {
+    chain: HeadWatcher(indexer.web3, ws_rpc=chain_configs[chain].ws_rpc, poll_interval=chain_configs[chain].poll_interval)
+    for chain, indexer in indexers.items()
+}
+
+# Every chain is indexed by its own task, so that a slow RPC or a stuck payment on one chain doesn't hold up the others
+indexer_tasks: dict[Chain, asyncio.Task] = {}
+indexer_restarts: dict[Chain, int] = {chain: 0 for chain in indexers}
+background_tasks: list[asyncio.Task] = []
+
+
+async def check_subscriptions(indexer: ChainIndexer, latest_block: int):
+    await indexer.discover_new_events(latest_block)
+    await indexer.pay_payable_subscriptions()
 
-async def loop():
+
+async def loop(chain: Chain):
     await asyncio.sleep(0.1)  # Allow the rest of the server to start
+    indexer = indexers[chain]
+    head_watcher = head_watchers[chain]
+    poll_interval = chain_configs[chain].poll_interval
+    checked_block: int | None = None
+    consecutive_failures = 0
     while True:
         try:
-            await check_subscriptions()
+            # A pass runs as soon as there is a new block, and only then
+            latest_block = await head_watcher.wait_for_new_block(after_block=checked_block)
+            await check_subscriptions(indexer, latest_block)
+            checked_block = latest_block
+            consecutive_failures = 0
         except Exception:
-            logging.error(f"Error while checking subscriptions: {traceback.format_exc()}")
-        
-        await asyncio.sleep(12)  # Almost no delay in the loop since we want to be checking subscriptions continuously
+            consecutive_failures += 1
+            logging.error(f"Error while checking subscriptions for chain {chain.name} ({consecutive_failures} failures in a row): {traceback.format_exc()}")
+            # Back off while the chain keeps failing, so that a broken RPC isn't hammered
+            await asyncio.sleep(min(poll_interval * 2 ** consecutive_failures, MAX_INDEXER_BACKOFF))
+
+
+def start_indexer(chain: Chain):
+    task = asyncio.create_task(loop(chain), name=f'indexer-{str(chain)}')
+    task.add_done_callback(lambda finished_task: on_indexer_finished(chain, finished_task))
+    indexer_tasks[chain] = task
+
+
+def on_indexer_finished(chain: Chain, task: asyncio.Task):
+    if task.cancelled():
+        return  # The server is shutting down
+
+    indexer_restarts[chain] += 1
+    logging.critical(f"Indexer task for chain {chain.name} has died with {task.exception()!r}. Restarting it (restart #{indexer_restarts[chain]}).")
+    start_indexer(chain)
 
 
 @app.get("/is_active/merchant/{merchant_domain}/userid/{userid}")
 async def does_user_have_an_active_subscription(merchant_domain: str, userid: str) -> bool:
-    subs = db.get_subscriptions_by_merchant_and_user(merchant_domain=merchant_domain, userid=userid)
-    return any([s.is_active for s in subs])
+    return db.entitlements.is_active(merchant_domain=merchant_domain, user_id=userid, timestamp=ts_now())
+
+
+@app.post("/is_active/merchant/{merchant_domain}")
+async def get_entitlements(merchant_domain: str, request: EntitlementsRequest) -> list[SerializedEntitlement]:
+    """Checks many users of a merchant at once. The results are in the order of the requested user ids."""
+    timestamp = ts_now()
+    entitlements = []
+    for user_id in request.user_ids:
+        entitlement = db.entitlements.get(merchant_domain=merchant_domain, user_id=user_id)
+        entitlements.append(SerializedEntitlement(
+            user_id=user_id,
+            is_active=entitlement is not None and entitlement.is_active(timestamp),
+            next_payment_at=entitlement.next_payment_at if entitlement is not None else None,
+        ))
+
+    return entitlements
+
+
+def subscription_filter_params(
+        status: SubscriptionStatus | None = None,
+        product_hash: str | None = None,
+        chain: str | None = None,
+        start_ts_from: int | None = None,
+        start_ts_to: int | None = None,
+        terminated: bool | None = None,
+) -> SubscriptionFilter:
+    try:
+        validated_chain = Chain.load(chain) if chain is not None else None
+    except AssertionError:
+        raise HTTPException(status_code=400, detail=f'{chain} is not a supported chain')
+
+    return SubscriptionFilter(
+        status=status,
+        product_hash=product_hash,
+        chain=validated_chain,
+        start_ts_from=start_ts_from,
+        start_ts_to=start_ts_to,
+        terminated=terminated,
+    )
 
 
-@app.get("/subscriptions/merchant/{merchant_domain}")
-async def get_subscriptions_by_merchant(merchant_domain: str) -> list[SerializedSubscription]:
-    subs = db.get_subscriptions_by_merchant(merchant_domain=merchant_domain)
-    return [sub.to_json() for sub in sort_subscriptions(subs)]
+async def list_subscriptions(
+        subscription_filter: SubscriptionFilter,
+        response: Response,
+        limit: int,
+        cursor: str | None,
+        stream: bool,
+) -> list[SerializedSubscription] | StreamingResponse:
+    """Subscriptions are listed newest first. The cursor of the next page, if any, is in the X-Next-Cursor header.
+
+    With stream=true, all subscriptions after the cursor are streamed as newline-delimited json instead.
+    """
+    try:
+        after = SubscriptionsCursor.decode(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'{cursor} is not a valid cursor')
+
+    if stream:
+        if not db.can_stream():
+            raise HTTPException(status_code=503, detail='Too many subscription streams are open, try again later')
+
+        async def serialize():
+            async for sub in db.stream_subscriptions(subscription_filter, after):
+                yield sub.to_json().model_dump_json() + '\n'
+
+        return StreamingResponse(serialize(), media_type='application/x-ndjson')
+
+    subs, next_cursor = await db.get_subscriptions_page(subscription_filter, limit=limit, after=after)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor.encode()
+
+    return [sub.to_json() for sub in subs]
+
+
+@app.get("/subscriptions/merchant/{merchant_domain}", response_model=list[SerializedSubscription])
+async def get_subscriptions_by_merchant(
+        merchant_domain: str,
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: str | None = None,
+        stream: bool = False,
+        subscription_filter: SubscriptionFilter = Depends(subscription_filter_params),
+) -> list[SerializedSubscription] | StreamingResponse:
+    return await list_subscriptions(subscription_filter._replace(merchant_domain=merchant_domain), response, limit, cursor, stream)
 
 
 @app.get("/subscriptions/merchant/{merchant_domain}/userid/{userid}")
 async def get_subscriptions_by_merchant_and_userid(merchant_domain: str, userid: str) -> list[SerializedSubscription]:
-    subs = db.get_subscriptions_by_merchant_and_user(merchant_domain=merchant_domain, userid=userid)
+    subs = await db.get_subscriptions_by_merchant_and_user(merchant_domain=merchant_domain, userid=userid)
     return [sub.to_json() for sub in sort_subscriptions(subs)]
 
 
 @app.get("/subscription/merchant/{merchant_domain}/id/{subscription_id}")
 async def get_subscription_by_merchant_and_subscriptionid(merchant_domain: str, subsciption_id: str) -> SerializedSubscription:
-    sub = db.get_subscription_by_merchant_and_subscriptionid(
+    sub = await db.get_subscription_by_merchant_and_subscriptionid(
         merchant_domain=merchant_domain,
         subscription_id=subsciption_id,
     )
@@ -119,33 +246,43 @@ async def get_subscription_by_merchant_and_subscriptionid(merchant_domain: str,
 
 @app.get("/subscription/{subscription_hash}")
 async def get_subscription_by_hash(subscription_hash: str) -> SerializedSubscription:
-    sub = db.get_subscription_by_hash(subscription_hash)
+    sub = await db.get_subscription_by_hash(subscription_hash)
     if sub is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
 
     return sub.to_json()
 
 
-@app.get("/subscriptions/user/{address}")
-async def get_subscriptions_by_user(address: str) -> list[SerializedSubscription]:
+@app.get("/subscriptions/user/{address}", response_model=list[SerializedSubscription])
+async def get_subscriptions_by_user(
+        address: str,
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: str | None = None,
+        stream: bool = False,
+        subscription_filter: SubscriptionFilter = Depends(subscription_filter_params),
+) -> list[SerializedSubscription] | StreamingResponse:
     try:
         validated_address = to_checksum_address(address)
     except Exception:
         raise HTTPException(status_code=400, detail=f'{address} is not a valid address')
 
-    subs = db.get_subscriptions_by_user(validated_address)
-    return [sub.to_json() for sub in sort_subscriptions(subs)]
+    return await list_subscriptions(subscription_filter._replace(user_address=validated_address), response, limit, cursor, stream)
 
 
-@app.get('/subscriptions/all')
-async def get_all_subscriptions() -> list[SerializedSubscription]:
-    subs = db.get_all_subscriptions()
-    return [sub.to_json() for sub in sort_subscriptions(subs)]
+@app.get('/subscriptions/all', response_model=list[SerializedSubscription])
+async def get_all_subscriptions(
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: str | None = None,
+        stream: bool = False,
+) -> list[SerializedSubscription] | StreamingResponse:
+    return await list_subscriptions(SubscriptionFilter(), response, limit, cursor, stream)
 
 
 @app.get("/subscription/{subscription_hash}/logs")
 async def get_subscription_logs(subscription_hash: str):
-    logs = db.get_subscription_logs(subscription_hash)
+    logs = await db.get_subscription_logs(subscription_hash)
     return [log.to_json() for log in logs]
 
 
@@ -155,7 +292,7 @@ async def save_metadata(request: Request) -> str:
     
     # Check if the metadata is already cached in our database
     decoded_metadata = metadata_bytes.decode(encoding='utf-8', errors='replace')
-    cached_ipfs_cid = db.get_metadata_ipfs_cid_by_content(decoded_metadata)
+    cached_ipfs_cid = await db.get_metadata_ipfs_cid_by_content(decoded_metadata)
     if cached_ipfs_cid is not None:
         return cached_ipfs_cid
     
@@ -169,7 +306,7 @@ async def save_metadata(request: Request) -> str:
         files={'file': metadata_stream}
     )
     ipfs_cid: str = response.json()['IpfsHash']
-    db.store_metadata(
+    await db.store_metadata(
         ipfs_cid=ipfs_cid,
         content=decoded_metadata,
     )
@@ -182,16 +319,16 @@ async def make_shortcut(request: Request) -> str:
     shortcut_id = base58.b58encode(random.randbytes(4)).decode()
 
     # Collision is not likely to happen, but still let's protect against it.
-    while db.get_shortcut(shortcut_id=shortcut_id) is not None:
+    while await db.get_shortcut(shortcut_id=shortcut_id) is not None:
         shortcut_id = base58.b58encode(random.randbytes(4)).decode()
     
-    db.save_shortcut(shortcut_id=shortcut_id, shortcut_content=shortcut_content)
+    await db.save_shortcut(shortcut_id=shortcut_id, shortcut_content=shortcut_content)
     return shortcut_id
 
 
 @app.get('/shortcut/{shortcut_id}')
 async def get_shortcut(shortcut_id: str) -> dict[str, Any]:
-    shortcut_content = db.get_shortcut(shortcut_id=shortcut_id)
+    shortcut_content = await db.get_shortcut(shortcut_id=shortcut_id)
     if shortcut_content is None:
         raise HTTPException(status_code=404, detail=f'No shortcut with id {shortcut_id}')
 
@@ -205,4 +342,25 @@ async def healthcheck():
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(loop())
+    await db.open()
+    for chain in indexers:
+        start_indexer(chain)
+
+    # Wake up the indexers on new heads, if the chain has a WebSocket RPC
+    for head_watcher in head_watchers.values():
+        background_tasks.append(asyncio.create_task(head_watcher.run()))
+
+    # Keep prices of all supported tokens fresh, so that payments don't wait for Binance
+    background_tasks.append(asyncio.create_task(price_oracle.keep_fresh(
+        symbol for chain in indexers for symbol in TOKEN_TO_BINANCE_SYMBOL[chain].values()
+    )))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in [*indexer_tasks.values(), *background_tasks]:
+        task.cancel()
+
+    await price_source.close()
+    await metadata_resolver.close()
+    await db.close()
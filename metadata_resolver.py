@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import Iterable
+import base58
+import httpx
+
+from constants import IPFS_VERSION, PINATA_BASE_URL
+from database import Database
+from utils import LRUCache, ts_now
+
+IPFS_REQUEST_TIMEOUT = 10  # seconds
+IPFS_MAX_ATTEMPTS = 3
+IPFS_RETRY_BACKOFF = 0.5  # seconds, doubled after every failed attempt
+IPFS_MAX_CONNECTIONS = 10
+
+METADATA_CACHE_SIZE = 1000
+NOT_FOUND_CACHE_TTL = 60 * 60  # CIDs that IPFS doesn't know about are not requested again for an hour
+
+
+def minimized_ipfs_cid_to_cid(minimized_ipfs_cid: bytes) -> str:
+    return base58.b58encode(IPFS_VERSION + minimized_ipfs_cid).decode(errors='replace')
+
+
+class MetadataResolver:
+    """Resolves metadata by IPFS CID from memory, the database or IPFS (through Pinata), in that order."""
+
+    def __init__(self, db: Database, base_url: str = PINATA_BASE_URL) -> None:
+        self.db = db
+        self.base_url = base_url
+        self._client = httpx.AsyncClient(
+            timeout=IPFS_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=IPFS_MAX_CONNECTIONS, max_keepalive_connections=IPFS_MAX_CONNECTIONS),
+        )
+        self._downloads = asyncio.Semaphore(IPFS_MAX_CONNECTIONS)
+        # Metadata is content-addressed, so it can be cached forever
+        self._metadata: LRUCache[str, str] = LRUCache(METADATA_CACHE_SIZE)
+        self._not_found_until: dict[str, int] = {}
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def prefetch(self, ipfs_cids: Iterable[str]) -> None:
+        await asyncio.gather(*[self.resolve(ipfs_cid) for ipfs_cid in set(ipfs_cids)])
+
+    async def resolve(self, ipfs_cid: str) -> str | None:
+        metadata = self._metadata.get(ipfs_cid)
+        if metadata is not None:
+            return metadata
+
+        metadata = await self.db.get_metadata_by_ipfs_cid(ipfs_cid)
+        if metadata is None:
+            if self._not_found_until.get(ipfs_cid, 0) > ts_now():
+                return None
+
+            logging.info(f"No metadata was found in the database for ipfs CID {ipfs_cid}. Will try to download it from IPFS.")
+            metadata = await self.download(ipfs_cid)
+            if metadata is None:
+                return None
+
+            await self.db.store_metadata(ipfs_cid=ipfs_cid, content=metadata)
+            logging.info(f"Stored metadata in the database for ipfs CID {ipfs_cid}.")
+
+        self._metadata.put(ipfs_cid, metadata)
+        return metadata
+
+    async def download(self, ipfs_cid: str) -> str | None:
+        for attempt in range(IPFS_MAX_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(IPFS_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            try:
+                async with self._downloads:
+                    response = await self._client.get(f'{self.base_url}/{ipfs_cid}')
+            except httpx.HTTPError as e:
+                logging.warning(f"Attempt {attempt + 1} to download ipfs CID {ipfs_cid} failed: {e!r}")
+                continue
+
+            if response.status_code == 200:
+                self._not_found_until.pop(ipfs_cid, None)
+                return response.text
+
+            if response.status_code == 404:
+                logging.error(f"No metadata was found on IPFS for ipfs CID {ipfs_cid}.")
+                self._not_found_until[ipfs_cid] = ts_now() + NOT_FOUND_CACHE_TTL
+                return None
+
+            logging.warning(f"Attempt {attempt + 1} to download ipfs CID {ipfs_cid} failed with status {response.status_code}")
+
+        logging.error(f"Could not download ipfs CID {ipfs_cid} after {IPFS_MAX_ATTEMPTS} attempts.")
+        return None
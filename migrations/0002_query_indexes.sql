@@ -0,0 +1,11 @@
+-- Access paths of the hot queries in database.py
+
+CREATE INDEX subscription_product_hash_idx ON subscription(product_hash);
+CREATE INDEX subscription_user_address_idx ON subscription(user_address);
+CREATE INDEX subscription_user_id_idx ON subscription(user_id);
+CREATE INDEX subscription_subscription_id_idx ON subscription(subscription_id);
+
+CREATE INDEX product_merchant_domain_idx ON product(merchant_domain);
+CREATE INDEX product_chain_idx ON product(chain);
+
+CREATE INDEX subscription_log_payment_idx ON subscription_log(subscription_hash, log_type, payment_number);
@@ -0,0 +1,18 @@
+-- Stored payment schedule, so that the payment scheduler only reads subscriptions that are due
+
+ALTER TABLE subscription ADD COLUMN next_payment_at BIGINT;
+ALTER TABLE subscription ADD COLUMN next_retry_at BIGINT NOT NULL DEFAULT 0; -- no payment attempt before this time after a payment issue
+ALTER TABLE subscription ADD COLUMN lapsed BOOLEAN NOT NULL DEFAULT FALSE; -- the payment period of the next payment has passed
+
+UPDATE subscription SET next_payment_at = subscription.start_ts + product.period * subscription.payments_made
+FROM product WHERE product.hash = subscription.product_hash;
+ALTER TABLE subscription ALTER COLUMN next_payment_at SET NOT NULL;
+
+UPDATE subscription SET next_retry_at = issue.timestamp + 60 * 60 * 24
+FROM (
+  SELECT subscription_hash, payment_number, MAX(timestamp) AS timestamp FROM subscription_log
+  WHERE log_type = 'payment-issue' GROUP BY subscription_hash, payment_number
+) AS issue
+WHERE issue.subscription_hash = subscription.hash AND issue.payment_number = subscription.payments_made + 1;
+
+CREATE INDEX subscription_due_idx ON subscription(GREATEST(next_payment_at, next_retry_at)) WHERE terminated = FALSE AND lapsed = FALSE;
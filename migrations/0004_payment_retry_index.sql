@@ -0,0 +1,3 @@
+-- Subscriptions waiting for a payment retry, whose tokens are watched for funding events
+
+CREATE INDEX subscription_retry_idx ON subscription(next_retry_at) WHERE terminated = FALSE AND lapsed = FALSE;
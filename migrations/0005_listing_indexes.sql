@@ -0,0 +1,6 @@
+-- Keyset pagination of subscription listings, ordered by (start_ts, hash)
+
+CREATE INDEX subscription_start_idx ON subscription(start_ts, hash);
+CREATE INDEX subscription_user_start_idx ON subscription(user_address, start_ts, hash);
+
+DROP INDEX subscription_user_address_idx; -- covered by subscription_user_start_idx
@@ -0,0 +1,13 @@
+-- Token metadata, resolved once per token instead of once per product
+
+CREATE TABLE token(
+  chain TEXT NOT NULL,
+  address TEXT NOT NULL,
+  symbol TEXT NOT NULL,
+  decimals BIGINT NOT NULL,
+  PRIMARY KEY(chain, address)
+);
+
+INSERT INTO token(chain, address, symbol, decimals)
+SELECT DISTINCT ON (chain, token_address) chain, token_address, token_symbol, token_decimals FROM product
+ORDER BY chain, token_address;
@@ -0,0 +1,10 @@
+-- Raw results of contract calls that never change, see call_cache.py
+
+CREATE TABLE contract_call_cache(
+  chain TEXT NOT NULL,
+  contract_address TEXT NOT NULL,
+  selector TEXT NOT NULL,
+  args TEXT NOT NULL, -- abi-encoded arguments
+  result TEXT NOT NULL, -- abi-encoded return data
+  PRIMARY KEY(chain, contract_address, selector, args)
+);
@@ -0,0 +1,10 @@
+-- Windows of router logs that were applied from blocks that are not final yet, so that they can be undone after a reorg
+
+CREATE TABLE block_checkpoint(
+  chain TEXT NOT NULL,
+  from_block BIGINT NOT NULL,
+  to_block BIGINT NOT NULL,
+  block_hash TEXT NOT NULL, -- of to_block
+  undo JSONB NOT NULL, -- the state that the window changed, as it was before the window
+  PRIMARY KEY(chain, to_block)
+);
@@ -0,0 +1,45 @@
+import asyncio
+import json
+from typing import Any, NamedTuple, cast
+from eth_typing import ChecksumAddress, HexStr
+from web3 import AsyncWeb3
+
+# Multicall3 is deployed at the same address on all supported chains. See https://www.multicall3.com/deployments
+MULTICALL3_ADDRESS = cast(ChecksumAddress, '0xcA11bde05977b3631167028862bE2a173976CA11')
+MULTICALL_BATCH_SIZE = 500  # calls per eth_call, to stay well below providers' gas and response size limits
+
+with open("abi/multicall3.json", 'r') as f:
+    MULTICALL3_ABI = json.loads(f.read())
+
+
+class Call(NamedTuple):
+    target: ChecksumAddress
+    call_data: HexStr
+    output_types: list[str]
+
+
+class Multicall:
+    def __init__(self, web3: AsyncWeb3) -> None:
+        self.web3 = web3
+        self.contract = web3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+
+    async def call(self, calls: list[Call]) -> list[tuple[Any, ...] | None]:
+        """Executes the calls in as few eth_calls as possible. A failed call results in None instead of its decoded outputs."""
+        batches = [calls[i:i + MULTICALL_BATCH_SIZE] for i in range(0, len(calls), MULTICALL_BATCH_SIZE)]
+        batch_results = await asyncio.gather(*[self._call_batch(batch) for batch in batches])
+        return [result for results in batch_results for result in results]
+
+    async def _call_batch(self, calls: list[Call]) -> list[tuple[Any, ...] | None]:
+        raw_results = await self.contract.functions.aggregate3([
+            (call.target, True, call.call_data)  # allowFailure, so that a single broken token doesn't fail the whole batch
+            for call in calls
+        ]).call()
+
+        results: list[tuple[Any, ...] | None] = []
+        for call, (success, return_data) in zip(calls, raw_results):
+            if success and len(return_data) > 0:
+                results.append(self.web3.codec.decode(call.output_types, return_data))
+            else:
+                results.append(None)
+
+        return results
@@ -0,0 +1,80 @@
+import asyncio
+from typing import NamedTuple
+from eth_typing import ChecksumAddress
+from hexbytes import HexBytes
+from web3 import AsyncWeb3
+from web3.exceptions import TransactionNotFound
+from web3.types import TxReceipt
+
+from common_types import Subscription
+
+
+class NonceManager:
+    """Hands out consecutive nonces of a single account locally, instead of asking the node before every transaction."""
+
+    def __init__(self, web3: AsyncWeb3, address: ChecksumAddress) -> None:
+        self.web3 = web3
+        self.address = address
+        self._next_nonce: int | None = None
+        self._lock = asyncio.Lock()
+
+    async def next_nonce(self) -> int:
+        async with self._lock:
+            if self._next_nonce is None:
+                # 'pending' also counts our transactions that are not in a block yet
+                self._next_nonce = await self.web3.eth.get_transaction_count(self.address, 'pending')
+
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
+
+    def reset(self) -> None:
+        """Must be called when a nonce was handed out but its transaction was not sent. The next nonce is re-synced from the node."""
+        self._next_nonce = None
+
+
+class PendingPayment(NamedTuple):
+    tx_hash: HexBytes
+    subscription: Subscription
+    payment_number: int
+    nonce: int
+    sent_at: int
+
+
+class ReceiptTracker:
+    """Payment transactions that were sent but are not confirmed yet. Their receipts are checked in bulk."""
+
+    def __init__(self, web3: AsyncWeb3) -> None:
+        self.web3 = web3
+        self._pending: dict[str, PendingPayment] = {}  # by subscription hash
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, payment: PendingPayment) -> None:
+        self._pending[payment.subscription.subscription_hash] = payment
+
+    def is_pending(self, subscription_hash: str) -> bool:
+        return subscription_hash in self._pending
+
+    def oldest_sent_at(self) -> int | None:
+        return min((payment.sent_at for payment in self._pending.values()), default=None)
+
+    async def poll(self) -> list[tuple[PendingPayment, TxReceipt]]:
+        """Returns payments that got into a block since the last poll, with their receipts, and stops tracking them."""
+        payments = list(self._pending.values())
+        receipts = await asyncio.gather(*[self._get_receipt(payment.tx_hash) for payment in payments])
+
+        confirmed: list[tuple[PendingPayment, TxReceipt]] = []
+        for payment, receipt in zip(payments, receipts):
+            if receipt is not None:
+                del self._pending[payment.subscription.subscription_hash]
+                confirmed.append((payment, receipt))
+
+        return confirmed
+
+    async def _get_receipt(self, tx_hash: HexBytes) -> TxReceipt | None:
+        try:
+            return await self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
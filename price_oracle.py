@@ -1,5 +1,10 @@
+import asyncio
+import logging
+import time
+import traceback
+from typing import Iterable, NamedTuple, Protocol
 from eth_typing import ChecksumAddress
-import requests
+import httpx
 from common_types import Chain
 from exceptions import UnsupportedToken
 
@@ -21,13 +26,102 @@ TOKEN_TO_BINANCE_SYMBOL = {
   }
 }
 
+PRICE_TTL = 30  # seconds during which a fetched price is used without asking the source again
+PRICE_MAX_STALENESS = 10 * 60  # seconds during which a price may still be used if the source fails or is slow
+PRICE_FETCH_TIMEOUT = 5  # seconds
 
-def get_token_to_eth_price(chain: Chain, token_address: ChecksumAddress) -> float:
+
+def get_binance_symbol(chain: Chain, token_address: ChecksumAddress) -> str:
   try:
-    binance_symbol = TOKEN_TO_BINANCE_SYMBOL[chain][token_address]
+    return TOKEN_TO_BINANCE_SYMBOL[chain][token_address]
   except KeyError as e:
     raise UnsupportedToken(f'Unsupported token {token_address} on chain {str(chain)}') from e
-  
-  response = requests.get(f'https://api.binance.com/api/v3/avgPrice?symbol={binance_symbol}').json()
-  price = float(response['price'])
-  return price
\ No newline at end of file
+
+
+class PriceSource(Protocol):
+  async def fetch_price(self, symbol: str) -> float:
+    ...
+
+
+class BinancePriceSource:
+  def __init__(self, base_url: str = 'https://api.binance.com') -> None:
+    self._client = httpx.AsyncClient(base_url=base_url, timeout=PRICE_FETCH_TIMEOUT)
+
+  async def close(self) -> None:
+    await self._client.aclose()
+
+  async def fetch_price(self, symbol: str) -> float:
+    response = await self._client.get('/api/v3/avgPrice', params={'symbol': symbol})
+    response.raise_for_status()
+    return float(response.json()['price'])
+
+
+class CachedPrice(NamedTuple):
+  price: float
+  fetched_at: float  # time.monotonic()
+
+
+class PriceOracle:
+  def __init__(
+      self,
+      source: PriceSource,
+      ttl: float = PRICE_TTL,
+      max_staleness: float = PRICE_MAX_STALENESS,
+      fetch_timeout: float = PRICE_FETCH_TIMEOUT,
+  ) -> None:
+    self.source = source
+    self.ttl = ttl
+    self.max_staleness = max_staleness
+    self.fetch_timeout = fetch_timeout
+    self._prices: dict[str, CachedPrice] = {}
+    # Concurrent requests for the same symbol wait for a single fetch
+    self._fetches: dict[str, asyncio.Task[float]] = {}
+
+  async def get_token_to_eth_price(self, chain: Chain, token_address: ChecksumAddress) -> float:
+    return await self.get_price(get_binance_symbol(chain, token_address))
+
+  async def get_price(self, symbol: str) -> float:
+    cached = self._prices.get(symbol)
+    if cached is not None and time.monotonic() - cached.fetched_at < self.ttl:
+      return cached.price
+
+    try:
+      # Shielded, so that a slow fetch keeps going and refreshes the cache even after we stop waiting for it
+      return await asyncio.wait_for(asyncio.shield(self._fetch(symbol)), timeout=self.fetch_timeout)
+    except Exception:
+      if cached is None or time.monotonic() - cached.fetched_at >= self.max_staleness:
+        raise
+
+      logging.warning(f'Could not fetch price for {symbol}, using a price fetched {time.monotonic() - cached.fetched_at:.0f} seconds ago. {traceback.format_exc()}')
+      return cached.price
+
+  async def keep_fresh(self, symbols: Iterable[str]) -> None:
+    """Refreshes prices of the symbols in the background, so that payments never wait for the source."""
+    symbols = set(symbols)
+    while True:
+      for symbol in symbols:
+        try:
+          await self._fetch(symbol)
+        except Exception:
+          logging.warning(f'Could not refresh price for {symbol}. {traceback.format_exc()}')
+
+      await asyncio.sleep(self.ttl / 2)
+
+  def _fetch(self, symbol: str) -> asyncio.Task[float]:
+    fetch = self._fetches.get(symbol)
+    if fetch is None:
+      fetch = asyncio.create_task(self._fetch_and_cache(symbol))
+      fetch.add_done_callback(lambda finished_fetch: self._on_fetch_done(symbol, finished_fetch))
+      self._fetches[symbol] = fetch
+
+    return fetch
+
+  def _on_fetch_done(self, symbol: str, fetch: asyncio.Task[float]) -> None:
+    self._fetches.pop(symbol, None)
+    if not fetch.cancelled():
+      fetch.exception()  # Marks a failure as retrieved even if nobody awaits the fetch anymore. Awaiting callers log it themselves.
+
+  async def _fetch_and_cache(self, symbol: str) -> float:
+    price = await self.source.fetch_price(symbol)
+    self._prices[symbol] = CachedPrice(price=price, fetched_at=time.monotonic())
+    return price
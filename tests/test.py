@@ -1,11 +1,29 @@
+import asyncio
+import json
 import os
-from unittest.mock import patch
+from types import SimpleNamespace
+from unittest.mock import PropertyMock, patch
 import pytest
-from common_types import Chain
+from block_range import AdaptiveBlockRange, is_range_error, is_rate_limit_error
+from common_types import Chain, Product, Subscription
 from constants import SEPOLIA_CONFIG
-from database import Database
-from chain_indexer import ChainIndexer
+import database
+from database import BlockCheckpoint, Database, SubscriptionFilter, WriteBatch
+from entitlements import EntitlementIndex
+from fee_estimator import FeeSnapshot
+from head_watcher import HeadWatcher
+from metadata_resolver import MetadataResolver
+from payment_pipeline import NonceManager, PendingPayment, ReceiptTracker
+from price_oracle import BinancePriceSource, PriceOracle
+from chain_indexer import PAYMENT_RECEIPT_TIMEOUT, ChainIndexer
 from dotenv import load_dotenv
+from eth_abi import encode
+from eth_utils import event_abi_to_log_topic, keccak
+from hexbytes import HexBytes
+from web3.contract.async_contract import AsyncContract
+from web3.datastructures import AttributeDict
+from web3.exceptions import BlockNotFound, TransactionNotFound
+import websockets
 
 from utils import ts_now
 
@@ -14,12 +32,35 @@ load_dotenv()
 # Not owned by anybody
 RANDOM_PRIVATE_KEY = 'af638f6032676be0068cd44e713c28fc5d4c984e77e24943b9cde1defcd57a9b'
 
-async def mock_and_discover_subscriptions(sepolia_indexer: ChainIndexer):
+async def make_test_db() -> Database:
+    db = Database(
+        name='indexer_test', 
+        user='beaver', 
+        host='localhost',
+        password='password',
+        port=5432,
+    )
+    await db.open()
+    await db.drop_all_tables()
+    await db.close()
+
+    db = Database(  # Re-initialize to create tables
+        name='indexer_test', 
+        user='beaver', 
+        host='localhost',
+        password='password',
+        port=5432,
+    )
+    await db.open()
+    return db
+
+
+async def mock_and_discover_events(sepolia_indexer: ChainIndexer):
     # Mock from_block and to_block
     from_block = 4483278
     to_block = from_block + 537  # 537 us just some random number to have some range and multiple calls to get_logs
 
-    sepolia_indexer.db.set_last_checked_subscriptions_block(chain=Chain.SEPOLIA, block=from_block)
+    await sepolia_indexer.db.set_last_checked_block(chain=Chain.SEPOLIA, block=from_block)
 
     async def to_block_mock():
         return to_block
@@ -27,74 +68,568 @@ async def mock_and_discover_subscriptions(sepolia_indexer: ChainIndexer):
     to_block_patch = patch('web3.eth.AsyncEth.block_number', new_callable=to_block_mock)
 
     with to_block_patch:
-        await sepolia_indexer.discover_new_subscriptions()
+        await sepolia_indexer.discover_new_events()
 
 
-async def mock_and_siscover_payments(sepolia_indexer: ChainIndexer):
-    # Mock from_block and to_block
-    from_block = 4483278
-    to_block = from_block + 537  # 537 us just some random number to have some range and multiple calls to get_logs
-    sepolia_indexer.db.set_last_checked_payments_block(chain=Chain.SEPOLIA, block=from_block)
+def test_adaptive_block_range():
+    block_range = AdaptiveBlockRange(initial_size=100, min_size=10, max_size=1000)
+    assert block_range.window_end(from_block=1, latest_block=10000) == 100
+    assert block_range.window_end(from_block=1, latest_block=50) == 50
 
-    async def to_block_mock():
-        return to_block
-    
-    to_block_patch = patch('web3.eth.AsyncEth.block_number', new_callable=to_block_mock)
+    block_range.on_response(logs_count=5, elapsed_seconds=0.1)
+    assert block_range.size == 200
+    block_range.on_response(logs_count=5000, elapsed_seconds=0.1)  # Too many logs
+    assert block_range.size == 200
+    block_range.on_response(logs_count=5, elapsed_seconds=30)  # Too slow
+    assert block_range.size == 200
 
-    with to_block_patch:
-        await sepolia_indexer.discover_new_payments()
+    for _ in range(10):
+        block_range.on_response(logs_count=0, elapsed_seconds=0.1)
+    assert block_range.size == 1000
+
+    assert is_range_error(ValueError({'code': -32005, 'message': 'query returned more than 10000 results'}))
+    assert is_range_error(TimeoutError())
+    assert not is_range_error(ValueError({'code': -32000, 'message': 'header not found'}))
+    assert is_rate_limit_error(ValueError("429, message='Too Many Requests'"))
+    assert not is_range_error(ValueError("429, message='Too Many Requests'"))
+    assert not is_range_error(ValueError({'code': -32005, 'message': 'project ID request rate exceeded'}))
+    assert not is_range_error(ValueError({'code': 429, 'message': 'request rate limited, exceeded limit of 25 requests per second'}))
+
+    while block_range.on_range_error():
+        pass
+    assert block_range.size == 10
+
+
+class StubPriceSource:
+    def __init__(self, price: float, delay: float = 0):
+        self.price = price
+        self.delay = delay
+        self.fetches = 0
+        self.failing = False
+
+    async def fetch_price(self, symbol: str) -> float:
+        self.fetches += 1
+        await asyncio.sleep(self.delay)
+        if self.failing:
+            raise RuntimeError('Source is down')
+
+        return self.price
 
 
 @pytest.mark.asyncio
-async def test_discover_new_subscriptions():
-    db = Database(
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
+async def test_price_oracle():
+    source = StubPriceSource(price=2000, delay=0.05)
+    oracle = PriceOracle(source, ttl=0.2, max_staleness=1, fetch_timeout=0.5)
+
+    # Concurrent requests are served by a single fetch and then from the cache
+    prices = await asyncio.gather(*[oracle.get_price('ETHUSDT') for _ in range(100)])
+    assert prices == [2000] * 100
+    assert await oracle.get_price('ETHUSDT') == 2000
+    assert source.fetches == 1
+
+    # A failing source falls back to the last good price while it's not too stale
+    await asyncio.sleep(0.2)
+    source.failing = True
+    assert await oracle.get_price('ETHUSDT') == 2000
+    assert source.fetches == 2
+
+    await asyncio.sleep(1)
+    with pytest.raises(RuntimeError):
+        await oracle.get_price('ETHUSDT')
+
+
+def test_entitlement_index():
+    entitlements = EntitlementIndex()
+    entitlements.update(merchant_domain='example.com', user_id='alice', active_until=1000, next_payment_at=900)
+    entitlements.update(merchant_domain='example.com', user_id='alice', active_until=500, next_payment_at=400)  # An older subscription doesn't shorten it
+    entitlements.update(merchant_domain='example.com', user_id=None, active_until=2000, next_payment_at=1900)
+
+    assert entitlements.is_active(merchant_domain='example.com', user_id='alice', timestamp=1000)
+    assert not entitlements.is_active(merchant_domain='example.com', user_id='alice', timestamp=1001)
+    assert not entitlements.is_active(merchant_domain='other.com', user_id='alice', timestamp=0)
+    assert entitlements.get(merchant_domain='example.com', user_id='alice').next_payment_at == 900
+    assert len(entitlements) == 1
+
+
+class StubEth:
+    def __init__(self, block_number: int = 0) -> None:
+        self.latest_block = block_number
+        self.polls = 0
+        self.transaction_count = 0
+        self.transaction_count_requests = 0
+        self.receipts: dict[bytes, AttributeDict] = {}
+        self.sent_transactions: list[bytes] = []
+
+    @property
+    async def block_number(self) -> int:
+        self.polls += 1
+        return self.latest_block
+
+    async def get_transaction_count(self, address: str, block_identifier: str) -> int:
+        self.transaction_count_requests += 1
+        return self.transaction_count
+
+    async def get_transaction_receipt(self, tx_hash: bytes) -> AttributeDict:
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(f'Transaction {tx_hash.hex()} not found')
+
+        return self.receipts[tx_hash]
+
+    async def send_raw_transaction(self, raw_transaction: bytes) -> HexBytes:
+        self.sent_transactions.append(raw_transaction)
+        return HexBytes(keccak(raw_transaction))
+
+
+class StubWeb3:
+    def __init__(self, block_number: int = 0) -> None:
+        self.eth = StubEth(block_number)
+
+
+@pytest.mark.asyncio
+async def test_head_watcher():
+    heads: asyncio.Queue[int | None] = asyncio.Queue()
+
+    async def stub_node(websocket):
+        request = json.loads(await websocket.recv())
+        assert request['method'] == 'eth_subscribe' and request['params'] == ['newHeads']
+        await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': '0x1'}))
+        while (head := await heads.get()) is not None:
+            await websocket.send(json.dumps({
+                'jsonrpc': '2.0',
+                'method': 'eth_subscription',
+                'params': {'subscription': '0x1', 'result': {'number': hex(head)}},
+            }))
+
+    async with websockets.serve(stub_node, 'localhost', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        web3 = StubWeb3(block_number=10)
+        watcher = HeadWatcher(web3, ws_rpc=f'ws://localhost:{port}', poll_interval=1)
+        watcher_task = asyncio.create_task(watcher.run())
+        try:
+            assert await watcher.wait_for_new_block(after_block=None) == 10
+            while not watcher.connected:
+                await asyncio.sleep(0.01)
+
+            # Pushed heads wake the waiter right away, without polling the node
+            polls = web3.eth.polls
+            heads.put_nowait(11)
+            assert await asyncio.wait_for(watcher.wait_for_new_block(after_block=10), timeout=0.5) == 11
+            assert web3.eth.polls == polls
+
+            # When the socket drops, new blocks are polled for
+            heads.put_nowait(None)
+            web3.eth.latest_block = 12
+            assert await asyncio.wait_for(watcher.wait_for_new_block(after_block=11), timeout=3) == 12
+        finally:
+            watcher_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_nonce_manager():
+    web3 = StubWeb3()
+    web3.eth.transaction_count = 7
+    nonce_manager = NonceManager(web3, '0x0000000000000000000000000000000000000001')
+
+    # Consecutive nonces are handed out locally after a single request to the node
+    assert await asyncio.gather(*[nonce_manager.next_nonce() for _ in range(5)]) == [7, 8, 9, 10, 11]
+    assert web3.eth.transaction_count_requests == 1
+
+    # The transaction with nonce 11 wasn't sent, so the next nonce is re-synced with the node
+    web3.eth.transaction_count = 11
+    nonce_manager.reset()
+    assert await nonce_manager.next_nonce() == 11
+    assert web3.eth.transaction_count_requests == 2
+
+
+def make_pending_payment(subscription_hash: str, sent_at: int) -> PendingPayment:
+    return PendingPayment(
+        tx_hash=HexBytes(keccak(text=subscription_hash)),
+        subscription=SimpleNamespace(subscription_hash=subscription_hash),
+        payment_number=2,
+        nonce=0,
+        sent_at=sent_at,
     )
-    db.drop_all_tables()
 
-    db = Database(  # Re-initialize to create tables
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
+
+@pytest.mark.asyncio
+async def test_receipt_tracker():
+    web3 = StubWeb3()
+    receipt_tracker = ReceiptTracker(web3)
+    confirmed_payment = make_pending_payment('01', sent_at=100)
+    pending_payment = make_pending_payment('02', sent_at=200)
+    receipt_tracker.add(confirmed_payment)
+    receipt_tracker.add(pending_payment)
+    assert receipt_tracker.oldest_sent_at() == 100
+
+    web3.eth.receipts[confirmed_payment.tx_hash] = AttributeDict({'status': 1, 'logs': []})
+    assert [payment for payment, _ in await receipt_tracker.poll()] == [confirmed_payment]
+
+    # Confirmed payments stop being tracked
+    assert len(receipt_tracker) == 1
+    assert not receipt_tracker.is_pending('01') and receipt_tracker.is_pending('02')
+    assert receipt_tracker.oldest_sent_at() == 200
+    assert await receipt_tracker.poll() == []
+
+
+def plan_node_types(plan: dict) -> list[str]:
+    return [plan['Node Type']] + [node_type for child in plan.get('Plans', []) for node_type in plan_node_types(child)]
+
+
+@pytest.mark.asyncio
+async def test_hot_queries_use_indexes():
+    db = await make_test_db()
+    queries = [
+        database.subscriptions_listing_sql(database.SubscriptionFilter(user_address='0x0000000000000000000000000000000000000001'), after=None, limit=100, timestamp=ts_now()),
+        database.subscriptions_listing_sql(database.SubscriptionFilter(merchant_domain='example.com', status='pending'), after=None, limit=100, timestamp=ts_now()),
+        database.subscriptions_listing_sql(database.SubscriptionFilter(), after=database.SubscriptionsCursor(start_ts=ts_now(), subscription_hash='0x00'), limit=100, timestamp=ts_now()),
+        (database.SUBSCRIPTIONS_BY_MERCHANT_AND_USER_SQL, ('example.com', 'user')),
+        (database.SUBSCRIPTION_BY_MERCHANT_AND_SUBSCRIPTIONID_SQL, ('example.com', 'subscription')),
+        (database.SUBSCRIPTION_BY_HASH_SQL, ('0x00',)),
+        (database.PAYABLE_SUBSCRIPTIONS_SQL, {'chain': str(Chain.SEPOLIA), 'timestamp': ts_now(), 'initiator': '0x0000000000000000000000000000000000000001', 'limit': 200}),
+    ]
+    for query, params in queries:
+        plan = await db.explain(query, params)
+        assert 'Seq Scan' not in plan_node_types(plan['Plan']), f'{query} does a sequential scan: {plan}'
+
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_rollback():
+    db = await make_test_db()
+    await db.store_metadata(ipfs_cid='cid', content='{}')
+    product = Product(
+        product_hash='0x01',
+        chain=Chain.SEPOLIA,
+        merchant_address='0x0000000000000000000000000000000000000001',
+        token_address='0x0000000000000000000000000000000000000002',
+        token_symbol='USDC',
+        token_decimals=6,
+        uint_amount=10 ** 6,
+        human_amount=1,
+        period=30 * 24 * 60 * 60,
+        free_trial_length=0,
+        payment_period=24 * 60 * 60,
+        metadata_cid='cid',
+        merchant_domain='example.com',
+        product_name='Product',
+    )
+    subscription = Subscription(
+        subscription_hash='0x02',
+        product=product,
+        user_address='0x0000000000000000000000000000000000000003',
+        start_ts=ts_now(),
+        payments_made=0,
+        terminated=False,
+        metadata_cid='cid',
+        subscription_id=None,
+        user_id='alice',
     )
 
-    sepolia_indexer = ChainIndexer(
+    first_batch = WriteBatch(chain=Chain.SEPOLIA, last_checked_block=10, checkpoint=BlockCheckpoint(from_block=1, to_block=10, block_hash='0xa'))
+    first_batch.add_product(product)
+    first_batch.add_subscription(subscription)
+    first_batch.update_payments_made(subscription_hash='0x02', new_payments_made=1)
+    await db.apply_write_batch(first_batch)
+
+    second_batch = WriteBatch(chain=Chain.SEPOLIA, last_checked_block=20, checkpoint=BlockCheckpoint(from_block=11, to_block=20, block_hash='0xb'))
+    second_batch.update_payments_made(subscription_hash='0x02', new_payments_made=2)
+    second_batch.terminate_subscription(subscription_hash='0x02')
+    await db.apply_write_batch(second_batch)
+    assert [checkpoint.to_block for checkpoint in await db.get_block_checkpoints(Chain.SEPOLIA)] == [20, 10]
+
+    await db.rollback(Chain.SEPOLIA, 10)
+    restored = await db.get_subscription_by_hash('0x02')
+    assert restored is not None and restored.payments_made == 1 and not restored.terminated
+    assert await db.get_last_checked_block(Chain.SEPOLIA, min_block=0) == 10
+
+    await db.rollback(Chain.SEPOLIA, 0)
+    assert await db.get_subscription_by_hash('0x02') is None
+    assert db.entitlements.get(merchant_domain='example.com', user_id='alice') is None
+    assert await db.get_block_checkpoints(Chain.SEPOLIA) == []
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_subscription_status_filter():
+    db = await make_test_db()
+    await db.store_metadata(ipfs_cid='cid', content='{}')
+    now = ts_now()
+    product = Product(
+        product_hash='0x01',
         chain=Chain.SEPOLIA,
-        rpc=SEPOLIA_CONFIG.rpc,
+        merchant_address='0x0000000000000000000000000000000000000001',
+        token_address='0x0000000000000000000000000000000000000002',
+        token_symbol='USDC',
+        token_decimals=6,
+        uint_amount=10 ** 6,
+        human_amount=1,
+        period=30 * 24 * 60 * 60,
+        free_trial_length=0,
+        payment_period=24 * 60 * 60,
+        metadata_cid='cid',
+        merchant_domain='example.com',
+        product_name='Product',
+    )
+
+    # One payment was made, so next_payment_at = start_ts + period
+    next_payments_at = {
+        '0x10': now,  # terminated
+        '0x11': now + 1,  # paid
+        '0x12': now,  # paid, at the boundary
+        '0x13': now,  # paid, with the same start_ts as the two above
+        '0x14': now - 1,  # pending
+        '0x15': now - product.payment_period,  # pending, at the boundary
+        '0x16': now - product.payment_period - 1,  # expired
+    }
+    subscriptions = [
+        Subscription(
+            subscription_hash=subscription_hash,
+            product=product,
+            user_address='0x0000000000000000000000000000000000000003',
+            start_ts=next_payment_at - product.period,
+            payments_made=1,
+            terminated=subscription_hash == '0x10',
+            metadata_cid='cid',
+            subscription_id=None,
+            user_id=None,
+        )
+        for subscription_hash, next_payment_at in next_payments_at.items()
+    ]
+    batch = WriteBatch(chain=Chain.SEPOLIA, last_checked_block=10)
+    batch.add_product(product)
+    for subscription in subscriptions:
+        batch.add_subscription(subscription)
+    await db.apply_write_batch(batch)
+
+    with patch('database.ts_now', return_value=now), patch('common_types.ts_now', return_value=now):
+        for status in ('terminated', 'paid', 'pending', 'expired'):
+            page, _ = await db.get_subscriptions_page(SubscriptionFilter(status=status), limit=100)
+            expected = {subscription.subscription_hash for subscription in subscriptions if subscription.status == status}
+            assert {subscription.subscription_hash for subscription in page} == expected, status
+
+    # Pages of 2 split the subscriptions with equal start_ts without losing or repeating any of them
+    listed: list[str] = []
+    cursor = None
+    while True:
+        page, cursor = await db.get_subscriptions_page(SubscriptionFilter(), limit=2, after=cursor)
+        listed += [subscription.subscription_hash for subscription in page]
+        if cursor is None:
+            break
+
+    ordered = sorted(subscriptions, key=lambda subscription: (subscription.start_ts, subscription.subscription_hash), reverse=True)
+    assert listed == [subscription.subscription_hash for subscription in ordered]
+    await db.close()
+
+
+def make_offline_indexer(db: Database, confirmations: int = 0) -> ChainIndexer:
+    return ChainIndexer(
+        chain=Chain.SEPOLIA,
+        rpc='http://localhost:1',  # Every call that a test needs is stubbed
         min_block=0,
         router_address=SEPOLIA_CONFIG.router_address,
         db=db,
+        metadata_resolver=MetadataResolver(db),
+        price_oracle=PriceOracle(BinancePriceSource()),
         initiator_private_key=RANDOM_PRIVATE_KEY,
-        priority_fee_wei=SEPOLIA_CONFIG.priority_fee_wei,
+        needs_poa_middleware=False,
+        confirmations=confirmations,
     )
-    await mock_and_discover_subscriptions(sepolia_indexer)
 
-    
+
+def make_raw_log(contract: AsyncContract, event_name: str, block_number: int, **args) -> AttributeDict:
+    event_abi = getattr(contract.events, event_name)().abi
+    indexed = [arg for arg in event_abi['inputs'] if arg['indexed']]
+    not_indexed = [arg for arg in event_abi['inputs'] if not arg['indexed']]
+    return AttributeDict({
+        'address': contract.address,
+        'topics': [HexBytes(event_abi_to_log_topic(event_abi))] + [HexBytes(encode([arg['type']], [args[arg['name']]])) for arg in indexed],
+        'data': HexBytes(encode([arg['type'] for arg in not_indexed], [args[arg['name']] for arg in not_indexed])),
+        'blockNumber': block_number,
+        'blockHash': HexBytes(b'\x00' * 32),
+        'logIndex': 0,
+        'transactionIndex': 0,
+        'transactionHash': HexBytes(b'\x00' * 32),
+    })
+
 
 @pytest.mark.asyncio
-async def test_discover_new_payments():
-    db = Database(
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
+async def test_rpc_errors_fail_the_window():
+    db = await make_test_db()
+    indexer = make_offline_indexer(db)
+    await db.set_last_checked_block(chain=Chain.SEPOLIA, block=50)
+    product_created = make_raw_log(
+        indexer.router,
+        'ProductCreated',
+        block_number=60,
+        productHash=b'\x01' * 32,
+        merchant='0x0000000000000000000000000000000000000001',
+        token='0x0000000000000000000000000000000000000002',
+        amount=10 ** 6,
+        period=30 * 24 * 60 * 60,
+        freeTrialLength=0,
+        paymentPeriod=24 * 60 * 60,
+        productMetadata=b'\x02' * 32,
     )
-    db.drop_all_tables()
 
-    db = Database(  # Re-initialize to create tables
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
+    async def get_logs(log_filter):
+        return [product_created]
+
+    def merchant_settings(merchant_address):
+        async def call():
+            raise ValueError({'code': -32005, 'message': 'limit exceeded'})
+
+        return SimpleNamespace(call=call)
+
+    # A lagging or rate-limiting node must not make the product, and with it its subscriptions, be skipped for good
+    with patch.object(indexer.web3.eth, 'get_logs', get_logs), patch.object(indexer.router.functions, 'merchantSettings', merchant_settings):
+        with pytest.raises(ValueError):
+            await indexer.discover_new_events(latest_block=100)
+
+    assert await db.get_last_checked_block(Chain.SEPOLIA, min_block=0) == 50
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_lagging_node_is_not_a_reorg():
+    db = await make_test_db()
+    indexer = make_offline_indexer(db, confirmations=10)
+    await db.apply_write_batch(WriteBatch(chain=Chain.SEPOLIA, last_checked_block=10, checkpoint=BlockCheckpoint(from_block=1, to_block=10, block_hash='0x0a')))
+    await db.apply_write_batch(WriteBatch(chain=Chain.SEPOLIA, last_checked_block=20, checkpoint=BlockCheckpoint(from_block=11, to_block=20, block_hash='0x14')))
+    block_hashes = {10: '0x0a'}  # The node is behind the newest checkpoint
+    node_block_number = 19
+
+    async def get_block(block_number):
+        if block_number not in block_hashes:
+            raise BlockNotFound(f'Block {block_number} not found')
+
+        return AttributeDict({'hash': HexBytes(block_hashes[block_number])})
+
+    async def get_block_number():
+        return node_block_number
+
+    async def get_logs(log_filter):
+        return []
+
+    with (
+        patch.object(indexer.web3.eth, 'get_block', get_block),
+        patch.object(indexer.web3.eth, 'get_logs', get_logs),
+        patch.object(type(indexer.web3.eth), 'block_number', new_callable=PropertyMock, side_effect=get_block_number),
+    ):
+        await indexer.discover_new_events(latest_block=25)
+        assert [checkpoint.to_block for checkpoint in await db.get_block_checkpoints(Chain.SEPOLIA)] == [20, 10]
+        assert await db.get_last_checked_block(Chain.SEPOLIA, min_block=0) == 20
+
+        # Once the node catches up, it is only checked up to its own latest block, even if the pushed head is newer
+        block_hashes.update({20: '0x14', 22: '0x16'})
+        node_block_number = 22
+        await indexer.discover_new_events(latest_block=25)
+        assert [checkpoint.to_block for checkpoint in await db.get_block_checkpoints(Chain.SEPOLIA)] == [22, 20]
+        assert await db.get_last_checked_block(Chain.SEPOLIA, min_block=0) == 22
+
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_payment_pipeline():
+    db = await make_test_db()
+    await db.store_metadata(ipfs_cid='cid', content='{}')
+    indexer = make_offline_indexer(db)
+    now = ts_now()
+    product = Product(
+        product_hash='01' * 32,
+        chain=Chain.SEPOLIA,
+        merchant_address='0x0000000000000000000000000000000000000001',
+        token_address='0x0000000000000000000000000000000000000002',
+        token_symbol='USDC',
+        token_decimals=6,
+        uint_amount=10 ** 6,
+        human_amount=1,
+        period=100,
+        free_trial_length=0,
+        payment_period=1000,
+        metadata_cid='cid',
+        merchant_domain='example.com',
+        product_name='Product',
     )
+    # The second payments of both are due
+    subscriptions = [
+        Subscription(
+            subscription_hash=subscription_hash,
+            product=product,
+            user_address='0x0000000000000000000000000000000000000003',
+            start_ts=now - 150,
+            payments_made=1,
+            terminated=False,
+            metadata_cid='cid',
+            subscription_id=None,
+            user_id=None,
+        )
+        for subscription_hash in ('02' * 32, '03' * 32)
+    ]
+    batch = WriteBatch(chain=Chain.SEPOLIA, last_checked_block=10)
+    batch.add_product(product)
+    batch.set_merchant_initiator(merchant_address=product.merchant_address, initiator=indexer.account.address)
+    for subscription in subscriptions:
+        batch.add_subscription(subscription)
+    await db.apply_write_batch(batch)
+
+    eth = StubEth(block_number=100)
+    eth.transaction_count = 7
+
+    async def get_token_to_eth_price(chain, token_address):
+        return 2000
+
+    async def get_snapshot(block_number):
+        return FeeSnapshot(block_number=block_number, next_base_fee=10 ** 9, priority_fee=10 ** 8)
+
+    async def multicall(calls):
+        return [(10 ** 18,)] * len(calls)  # Enough balance and allowance for everything
+
+    async def get_block_number():
+        return eth.latest_block
+
+    with (
+        patch.object(indexer.web3.eth, 'get_transaction_count', eth.get_transaction_count),
+        patch.object(indexer.web3.eth, 'get_transaction_receipt', eth.get_transaction_receipt),
+        patch.object(indexer.web3.eth, 'send_raw_transaction', eth.send_raw_transaction),
+        patch.object(type(indexer.web3.eth), 'block_number', new_callable=PropertyMock, side_effect=get_block_number),
+        patch.object(indexer.price_oracle, 'get_token_to_eth_price', get_token_to_eth_price),
+        patch.object(indexer.fee_estimator, 'get_snapshot', get_snapshot),
+        patch.object(indexer.multicall, 'call', multicall),
+    ):
+        await indexer.pay_payable_subscriptions()
+        assert len(eth.sent_transactions) == 2
+        assert sorted(payment.nonce for payment in indexer.receipt_tracker._pending.values()) == [7, 8]
+
+        # Subscriptions with a payment in flight are not paid again
+        await indexer.pay_payable_subscriptions()
+        assert len(eth.sent_transactions) == 2
+
+        # Only the PaymentMade of our router for the paid subscription counts, not ones of other subscriptions or contracts in the same receipt
+        paid = indexer.receipt_tracker._pending[subscriptions[0].subscription_hash]
+        payment_made = make_raw_log(indexer.router, 'PaymentMade', block_number=101, subscriptionHash=bytes.fromhex(subscriptions[0].subscription_hash), paymentNumber=2)
+        other_subscription = make_raw_log(indexer.router, 'PaymentMade', block_number=101, subscriptionHash=bytes.fromhex(subscriptions[1].subscription_hash), paymentNumber=5)
+        other_contract = AttributeDict({**payment_made, 'address': '0x0000000000000000000000000000000000000004'})
+        eth.receipts[paid.tx_hash] = AttributeDict({'status': 1, 'logs': [other_contract, payment_made, other_subscription]})
+        await indexer.pay_payable_subscriptions()
+        assert (await db.get_subscription_by_hash(subscriptions[0].subscription_hash)).payments_made == 2
+        assert (await db.get_subscription_by_hash(subscriptions[1].subscription_hash)).payments_made == 1
+        assert len(indexer.receipt_tracker) == 1
+        assert len(eth.sent_transactions) == 2
+
+        # A payment that is not in a block after PAYMENT_RECEIPT_TIMEOUT means that the initiator is stuck
+        with patch('chain_indexer.ts_now', return_value=now + PAYMENT_RECEIPT_TIMEOUT + 10):
+            await indexer.pay_payable_subscriptions()
+        assert not await db.get_initiator_available(Chain.SEPOLIA)
+        assert len(eth.sent_transactions) == 2
+
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_discover_new_events():
+    db = await make_test_db()
 
     sepolia_indexer = ChainIndexer(
         chain=Chain.SEPOLIA,
@@ -102,40 +637,30 @@ async def test_discover_new_payments():
         min_block=0,
         router_address=SEPOLIA_CONFIG.router_address,
         db=db,
+        metadata_resolver=MetadataResolver(db),
+        price_oracle=PriceOracle(BinancePriceSource()),
         initiator_private_key=RANDOM_PRIVATE_KEY,
-        priority_fee_wei=SEPOLIA_CONFIG.priority_fee_wei,
+        needs_poa_middleware=SEPOLIA_CONFIG.needs_poa_middleware,
+        confirmations=SEPOLIA_CONFIG.confirmations,
     )
-    await mock_and_discover_subscriptions(sepolia_indexer)
-    await mock_and_siscover_payments(sepolia_indexer)
+    await mock_and_discover_events(sepolia_indexer)
 
+    
 
 @pytest.mark.asyncio
 async def test_pay():
-    db = Database(
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
-    )
-    db.drop_all_tables()
-
-    db = Database(  # Re-initialize to create tables
-        name='indexer_test', 
-        user='beaver', 
-        host='localhost',
-        password='password',
-        port=5432,
-    )
+    db = await make_test_db()
     sepolia_indexer = ChainIndexer(
         chain=Chain.SEPOLIA,
         rpc=SEPOLIA_CONFIG.rpc,
         min_block=0,
         router_address=SEPOLIA_CONFIG.router_address,
         db=db,
+        metadata_resolver=MetadataResolver(db),
+        price_oracle=PriceOracle(BinancePriceSource()),
         initiator_private_key=os.environ['INITIATOR_PRIVATE_KEY'],
-        priority_fee_wei=SEPOLIA_CONFIG.priority_fee_wei,
+        needs_poa_middleware=SEPOLIA_CONFIG.needs_poa_middleware,
+        confirmations=SEPOLIA_CONFIG.confirmations,
     )
-    await mock_and_discover_subscriptions(sepolia_indexer)
-    await mock_and_siscover_payments(sepolia_indexer)
+    await mock_and_discover_events(sepolia_indexer)
     await sepolia_indexer.pay_payable_subscriptions()
@@ -1,5 +1,6 @@
 import time
-from typing import TYPE_CHECKING, Iterable
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Generic, Iterable, TypeVar
 
 if TYPE_CHECKING:
     from common_types import Subscription
@@ -14,3 +15,34 @@ def sort_subscriptions(subscriptions: Iterable['Subscription']) -> list['Subscri
         key=lambda sub: sub.start_ts,
         reverse=True,
     )
+
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class LRUCache(Generic[K, V]):
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._items: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: K) -> V | None:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()